@@ -1,77 +1,1124 @@
-from flask import Flask, request, send_file, render_template, redirect, url_for
+from flask import Flask, Response, request, send_file, render_template, redirect, url_for, jsonify, abort
 import os
-import pandas as pd
+import importlib
 import requests
-from PIL import Image
+import urllib3
+from PIL import Image, features
 from io import BytesIO
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import zipfile
-import rembg
-from rembg import remove
+import threading
+import hashlib
+import json
+import re
+import shutil
+import uuid
+import multiprocessing
+import bisect
+import random
+import tempfile
+import csv
+import itertools
+import sqlite3
+from collections import deque, OrderedDict
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
 from celery import Celery
 import time
-import fitz  
 import io
 from PIL import Image
 
+class LazyModule:
+    # Stands in for a heavy module until one of its attributes is first used, so
+    # processes that never touch a route pay nothing for its imports. The import
+    # runs once, under a lock, however many threads hit it at the same time.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+rembg = LazyModule('rembg')
+fitz = LazyModule('fitz')
+
 app = Flask(__name__)
 
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
 DROPBOX_TEMP_FOLDER = 'dropbox_temp'
 DROPBOX_ZIP_FILENAME = 'dropbox_downloaded_images.zip'
+UPLOAD_ZIP_FILENAME = 'processed_images.zip'
+PDF_ZIP_FILENAME = 'extracted_images.zip'
+PDF_PAGES_ZIP_FILENAME = 'rendered_pages.zip'
+FAILED_ROWS_FILENAME = 'failed_rows.csv'
+JOBS_FOLDER = 'jobs'
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
 app.config['DROPBOX_TEMP_FOLDER'] = DROPBOX_TEMP_FOLDER
+app.config['JOBS_FOLDER'] = JOBS_FOLDER
+
+# Download engine: one pooled keep-alive session shared by all download threads,
+# with a global worker limit and an adaptive per-host limit so a single CDN is
+# not hammered. Each host starts at DOWNLOAD_PER_HOST concurrent requests, grows
+# towards DOWNLOAD_PER_HOST_MAX while responses stay fast, and halves on 429,
+# 5xx and connection errors. Those attempts are retried up to DOWNLOAD_RETRIES
+# times after a jittered exponential backoff, or after Retry-After when the
+# server sends one (up to DOWNLOAD_MAX_RETRY_AFTER seconds; longer requests are
+# failed without pausing the host). Rows still queued behind a paused host
+# DOWNLOAD_QUEUE_DEADLINE seconds after they were read are failed. The CSV is
+# read ahead until DOWNLOAD_WORKERS * 4 rows are queued for hosts that can take
+# a request now; rows for paused or saturated hosts do not count, so reading
+# carries on for the other hosts, up to DOWNLOAD_MAX_QUEUED rows in total.
+app.config['DOWNLOAD_WORKERS'] = 16
+app.config['DOWNLOAD_PER_HOST'] = 4
+app.config['DOWNLOAD_PER_HOST_MAX'] = 16
+app.config['DOWNLOAD_TIMEOUT'] = (10, 60)
+app.config['DOWNLOAD_RETRIES'] = 4
+app.config['DOWNLOAD_BACKOFF_BASE'] = 0.5
+app.config['DOWNLOAD_BACKOFF_MAX'] = 30
+app.config['DOWNLOAD_MAX_RETRY_AFTER'] = 300
+app.config['DOWNLOAD_QUEUE_DEADLINE'] = 600
+app.config['DOWNLOAD_MAX_QUEUED'] = 20000
+
+# Image bodies are streamed in DOWNLOAD_CHUNK_SIZE chunks into a buffer that
+# spills to disk past DOWNLOAD_SPOOL_BYTES. A download is abandoned once it
+# passes DOWNLOAD_MAX_BYTES or runs longer than DOWNLOAD_DEADLINE seconds, and
+# an image is rejected before decoding if it has more than DOWNLOAD_MAX_PIXELS.
+# Each job holds at most JOB_INFLIGHT_BYTES of (estimated) decoded images.
+app.config['DOWNLOAD_CHUNK_SIZE'] = 64 * 1024
+app.config['DOWNLOAD_SPOOL_BYTES'] = 1024 * 1024
+app.config['DOWNLOAD_MAX_BYTES'] = 50 * 1024 * 1024
+app.config['DOWNLOAD_DEADLINE'] = 120
+app.config['DOWNLOAD_MAX_PIXELS'] = 50 * 1000 * 1000
+app.config['JOB_INFLIGHT_BYTES'] = 512 * 1024 * 1024
+
+# Within a job, rows whose URLs normalize to the same string are fetched once
+# and downloads with identical bytes are processed once; the output is written
+# under every requested name. The outcomes of the last BATCH_DEDUP_MAX_URLS
+# finished URLs are remembered for repeats later in the CSV.
+app.config['BATCH_DEDUP_MAX_URLS'] = 100000
+
+# Header names accepted for the image CSV columns of /upload and /dropbox, in
+# order of preference, compared ignoring case and extra whitespace. Rows are
+# read one at a time and handed to the downloader as they are parsed.
+app.config['IMAGE_COLUMN_ALIASES'] = {
+    'Image link': ['Image link', 'Images link 1', 'Image link 1', 'Image URL'],
+    'Image Name': ['Image Name', 'Image Name_1', 'Mat Code'],
+}
+
+# Raw downloads are cached on disk by normalized URL and revalidated with
+# If-None-Match / If-Modified-Since; least recently used entries go first once
+# the cache grows past HTTP_CACHE_MAX_BYTES.
+app.config['HTTP_CACHE_FOLDER'] = 'http_cache'
+app.config['HTTP_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+
+# Processed images are cached on disk by (SHA-256 of the source bytes, stages,
+# output format and encoder settings) so rerunning the same or an overlapping
+# CSV only processes new or changed images. Least recently used outputs are
+# evicted past OUTPUT_CACHE_MAX_BYTES, and both caches are trimmed to their
+# budgets by delete_old_files.
+app.config['OUTPUT_CACHE_FOLDER'] = 'output_cache'
+app.config['OUTPUT_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+
+# Background removal runs in one shared pool of worker processes; each worker
+# loads the default rembg model at start and other models the first time a job
+# asks for them, with single-threaded onnxruntime sessions so the pool uses
+# about REMBG_WORKERS cores in total. REMBG_WORKERS = 0 runs it in the calling
+# process instead (needed where child processes are not allowed, e.g. inside
+# Celery prefork workers).
+app.config['REMBG_MODEL'] = 'u2net'
+app.config['REMBG_MODELS'] = ['u2net', 'u2netp', 'u2net_human_seg', 'isnet-general-use', 'silueta']
+app.config['REMBG_WORKERS'] = os.cpu_count() or 1
+
+# Background removal quality, chosen per job. 'full' sends the full-size image
+# to rembg. The others infer the mask on a copy whose longer side is at most
+# this many pixels, upsample it, sharpen its edges and composite the original
+# onto white. The models predict at 320-1024 px internally anyway, so the mask
+# barely changes while the PNG round trips and mask resize get much cheaper.
+app.config['REMBG_QUALITIES'] = {'full': None, 'balanced': 1024, 'fast': 512}
+app.config['PROCESS_WORKERS'] = 2 * (os.cpu_count() or 1)
+
+app.config['RESIZE_FIT_MODES'] = ['stretch', 'fit', 'fill', 'pad']
+app.config['RESIZE_REDUCING_GAP'] = 3.0
+
+# Output encodings for /upload and /dropbox as (PIL format, extension, save
+# options). 'jpeg' is the original quality 95 output. With a byte budget the
+# quality is searched per image, down to OUTPUT_MIN_QUALITY, to fit it. For
+# the job report a sample of images is also encoded as 'jpeg' to estimate
+# the bytes saved.
+app.config['OUTPUT_FORMATS'] = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 95}),
+    'jpeg_progressive': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'avif': ('AVIF', 'avif', {'quality': 60, 'speed': 8}),
+}
+# Pillow only encodes AVIF from 11.3, and only when built with libavif.
+if not features.check('avif'):
+    del app.config['OUTPUT_FORMATS']['avif']
+app.config['OUTPUT_MIN_QUALITY'] = 20
+
+# Downloads already in one of these output formats, in RGB or grayscale, are
+# written as downloaded when the stages would not change them (no stages, or a
+# resize to the size they already have) and they fit the byte budget. Decided
+# from the image header, so such images are never decoded or re-encoded.
+app.config['PASSTHROUGH_FORMATS'] = ['jpeg']
+app.config['OUTPUT_BASELINE_SAMPLE_RATE'] = 0.1
+
+# Per-stage latency histograms and byte counters, labelled by route and option,
+# exposed in Prometheus text format at /metrics and summarized in each job's
+# status. METRICS_ENABLED=0 turns recording (and the endpoint) off. The
+# registry is per process: with several gunicorn workers (or a Celery worker)
+# each scrape only sees the process that answered it, so scrape every worker
+# or rely on the per-job summaries.
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['METRICS_BUCKETS'] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+http_session = None
+http_lock = threading.Lock()
+host_limits = {}
+http_cache_lock = threading.Lock()
+http_cache_size = None
+output_cache_lock = threading.Lock()
+output_cache_size = None
+metrics_lock = threading.Lock()
+stage_metrics = {}
+
+def observe_stage(stage, route, option, seconds, nbytes=0):
+    buckets = app.config['METRICS_BUCKETS']
+    key = (stage, route or '', option or '')
+    with metrics_lock:
+        metric = stage_metrics.get(key)
+        if metric is None:
+            metric = stage_metrics[key] = {'buckets': [0] * (len(buckets) + 1), 'count': 0, 'sum': 0.0, 'bytes': 0}
+        metric['buckets'][bisect.bisect_left(buckets, seconds)] += 1
+        metric['count'] += 1
+        metric['sum'] += seconds
+        metric['bytes'] += nbytes
+
+def metric_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics():
+    buckets = app.config['METRICS_BUCKETS']
+    lines = [
+        '# HELP image_stage_seconds Time spent in each pipeline stage.',
+        '# TYPE image_stage_seconds histogram',
+    ]
+    with metrics_lock:
+        metrics = sorted((key, dict(metric, buckets=list(metric['buckets']))) for key, metric in stage_metrics.items())
+    for (stage, route, option), metric in metrics:
+        labels = f'stage="{metric_label(stage)}",route="{metric_label(route)}",option="{metric_label(option)}"'
+        cumulative = 0
+        for bound, count in zip(buckets + ['+Inf'], metric['buckets']):
+            cumulative += count
+            lines.append(f'image_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'image_stage_seconds_sum{{{labels}}} {metric["sum"]}')
+        lines.append(f'image_stage_seconds_count{{{labels}}} {metric["count"]}')
+    lines += [
+        '# HELP image_stage_bytes_total Bytes produced by each pipeline stage.',
+        '# TYPE image_stage_bytes_total counter',
+    ]
+    for (stage, route, option), metric in metrics:
+        labels = f'stage="{metric_label(stage)}",route="{metric_label(route)}",option="{metric_label(option)}"'
+        lines.append(f'image_stage_bytes_total{{{labels}}} {metric["bytes"]}')
+    return '\n'.join(lines) + '\n'
+
+class JobStats:
+    # Counters for one job. When the job has an id, counters and state are also
+    # written to the job's status.json (at most every SAVE_INTERVAL seconds
+    # unless forced) so /jobs/<job_id> can report progress from any process.
+    # observe() records stage timings under the job's kind and option.
+    SAVE_INTERVAL = 0.5
+
+    def __init__(self, job_id=None, **fields):
+        self.lock = threading.Lock()
+        self.job_id = job_id
+        self.counts = {}
+        self.stages = {}
+        self.failures = []
+        self.fields = read_job_status(job_id) if job_id else {}
+        self.fields.update(fields)
+        self.fields.pop('counts', None)
+        self.fields.pop('stages', None)
+        self.saved_at = 0
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+        self.save()
+
+    def fail(self, image_name, url, reason):
+        with self.lock:
+            self.failures.append((image_name, url, reason))
+        self.incr('rows_failed')
+
+    def failed_rows_csv(self):
+        with self.lock:
+            if not self.failures:
+                return None
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['Image Name', 'Image link', 'Reason'])
+            writer.writerows(self.failures)
+        return buffer.getvalue().encode('utf-8')
+
+    def observe(self, stage, seconds, nbytes=0):
+        if not app.config['METRICS_ENABLED']:
+            return
+        observe_stage(stage, self.fields.get('kind'), self.fields.get('option'), seconds, nbytes)
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+
+    def summary(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def stage_summary(self):
+        with self.lock:
+            return {stage: dict(totals) for stage, totals in self.stages.items()}
+
+    def save(self, force=False, **fields):
+        if self.job_id is None:
+            return
+        with self.lock:
+            self.fields.update(fields)
+            now = time.time()
+            if not force and now - self.saved_at < self.SAVE_INTERVAL:
+                return
+            self.saved_at = now
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+            write_job_status(self.job_id, dict(self.fields, counts=dict(self.counts), stages=stages))
+
+def print_job_stats(stats):
+    counts = stats.summary()
+    print(f"HTTP cache: {counts.get('cache_hits', 0)} hits, {counts.get('cache_misses', 0)} misses, "
+          f"{counts.get('cache_bytes_saved', 0)} bytes not re-downloaded")
+    if counts.get('fetches_saved') or counts.get('processing_runs_saved'):
+        print(f"Batch dedup: {counts.get('fetches_saved', 0)} fetches and "
+              f"{counts.get('processing_runs_saved', 0)} processing runs saved")
+    if counts.get('output_cache_hits') or counts.get('output_cache_misses'):
+        print(f"Output cache: {counts.get('output_cache_hits', 0)} hits, {counts.get('output_cache_misses', 0)} misses")
+    if counts.get('passthrough'):
+        print(f"Pass-through: {counts['passthrough']} images written as downloaded")
+    if counts.get('sampled_baseline_bytes'):
+        print(f"Output: {counts['output_bytes']} bytes, about {output_saving(counts):.0%} smaller than JPEG quality 95")
+    for stage, totals in stats.stage_summary().items():
+        print(f"Stage {stage}: {totals['count']} calls, {totals['seconds']:.2f}s, {totals['bytes']} bytes")
+
+def output_saving(counts):
+    # Fraction of bytes saved versus the default JPEG output, estimated from the sampled images.
+    return 1 - counts['sampled_output_bytes'] / counts['sampled_baseline_bytes']
 
 def is_valid_url(url):
     parsed = urlparse(url)
     return bool(parsed.netloc) and bool(parsed.scheme)
 
-def download_image(url):
+def get_http_session():
+    global http_session
+    with http_lock:
+        if http_session is None:
+            pool_size = app.config['DOWNLOAD_WORKERS']
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_session = session
+        return http_session
+
+class HostLimiter:
+    # Additive-increase / multiplicative-decrease concurrency limit for one host,
+    # shared by every job. Each fast success adds 1/limit (about one slot per
+    # round of requests), ten times slower within one slot of the limit that
+    # last caused congestion; success while latency is over twice the best seen
+    # holds the limit; congestion halves it, at most once per round trip so
+    # one overload burst counts once. A Retry-After pauses new requests.
+    def __init__(self, limit, max_limit):
+        self.lock = threading.Lock()
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.paused_until = 0
+        self.congested_limit = None
+        self.latency = None
+        self.best_latency = None
+        self.decreased_at = 0
+
+    def paused(self):
+        return time.monotonic() < self.paused_until
+
+    def blocked(self):
+        # True while try_acquire would fail.
+        with self.lock:
+            return self.in_flight >= int(self.limit) or time.monotonic() < self.paused_until
+
+    def try_acquire(self):
+        with self.lock:
+            if self.in_flight >= int(self.limit) or time.monotonic() < self.paused_until:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, congested=False, retry_after=None):
+        with self.lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + min(retry_after, app.config['DOWNLOAD_MAX_RETRY_AFTER']))
+            if congested:
+                if now - self.decreased_at > (self.latency or 1):
+                    self.congested_limit = self.limit
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased_at = now
+                return
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.best_latency = min(self.best_latency or self.latency, self.latency)
+            if self.latency <= 2 * self.best_latency:
+                step = 1 / self.limit
+                if self.congested_limit and self.limit + 1 >= self.congested_limit:
+                    step /= 10
+                self.limit = min(self.max_limit, self.limit + step)
+
+def url_host(url):
+    return urlparse(url).netloc.lower()
+
+def get_host_limit(host):
+    with http_lock:
+        if host not in host_limits:
+            host_limits[host] = HostLimiter(app.config['DOWNLOAD_PER_HOST'], app.config['DOWNLOAD_PER_HOST_MAX'])
+        return host_limits[host]
+
+def fetch_url(url, headers=None, stream=False):
+    return get_http_session().get(url, headers=headers, stream=stream, timeout=app.config['DOWNLOAD_TIMEOUT'])
+
+class DownloadFailed(Exception):
+    pass
+
+class DownloadRejected(DownloadFailed):
+    pass
+
+class DownloadThrottled(DownloadFailed):
+    # A response worth retrying; retry_after is the server's Retry-After in seconds, if any.
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    delay = min(app.config['DOWNLOAD_BACKOFF_MAX'], app.config['DOWNLOAD_BACKOFF_BASE'] * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, retry_after or 0)
+
+class ByteBudget:
+    # Blocks acquire() while taking `amount` more bytes would exceed `limit`. An
+    # item larger than the whole limit still goes through once nothing else is held.
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            while self.used and self.used + amount > self.limit:
+                self.condition.wait()
+            self.used += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+def response_socket(response):
+    # The socket under a streamed requests response, or None where it cannot be
+    # reached. This walks private urllib3/http.client attributes; when they are
+    # missing the deadline is only checked between reads, so a stalled server
+    # is bounded by the read timeout instead of the time left.
+    fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+    return getattr(getattr(fp, 'raw', None), '_sock', None)
+
+def read_response(response):
+    # Returns (file, size) with the response body spooled in chunks; raises
+    # DownloadRejected as soon as the body is too large or too slow.
+    max_bytes = app.config['DOWNLOAD_MAX_BYTES']
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise DownloadRejected(f"Content-Length {length} is over the {max_bytes} byte limit")
+
+    # Reads return whatever one socket read delivers, so the deadline holds for
+    # servers that trickle bytes too, and the socket timeout is shrunk to the
+    # time left so a stalled server cannot outlast it either.
+    deadline = time.monotonic() + app.config['DOWNLOAD_DEADLINE']
+    deadline_error = f"transfer took longer than {app.config['DOWNLOAD_DEADLINE']} seconds"
+    read_timeout = app.config['DOWNLOAD_TIMEOUT'][1]
+    sock = response_socket(response)
+    # urllib3 1.x has no read1; read() waits for a full chunk (or the read
+    # timeout), so the deadline is only checked once per chunk there.
+    read = getattr(response.raw, 'read1', None) or response.raw.read
+    data = tempfile.SpooledTemporaryFile(max_size=app.config['DOWNLOAD_SPOOL_BYTES'])
+    size = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DownloadRejected(deadline_error)
+            # Once the body is complete the connection may already be closed or
+            # back in the pool, serving another request.
+            if sock is not None and not response.raw.closed:
+                sock.settimeout(min(read_timeout, remaining))
+            try:
+                chunk = read(app.config['DOWNLOAD_CHUNK_SIZE'], decode_content=True)
+            except urllib3.exceptions.ReadTimeoutError as e:
+                if time.monotonic() >= deadline:
+                    raise DownloadRejected(deadline_error)
+                raise requests.ConnectionError(e)
+            except urllib3.exceptions.ProtocolError as e:
+                raise requests.exceptions.ChunkedEncodingError(e)
+            except urllib3.exceptions.DecodeError as e:
+                raise requests.exceptions.ContentDecodingError(e)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise DownloadRejected(f"body is over the {max_bytes} byte limit")
+            data.write(chunk)
+    except BaseException:
+        data.close()
+        raise
+    data.seek(0)
+    return data, size
+
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/', parsed.params, query, ''))
+
+def http_cache_paths(url):
+    key = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+    folder = app.config['HTTP_CACHE_FOLDER']
+    return os.path.join(folder, key + '.bin'), os.path.join(folder, key + '.json')
+
+def read_http_cache_meta(url):
+    data_path, meta_path = http_cache_paths(url)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def open_http_cache_data(url):
+    data_path, meta_path = http_cache_paths(url)
+    try:
+        data = open(data_path, 'rb')
+    except OSError:
+        return None
+    os.utime(data_path)
+    return data
+
+def write_http_cache(url, headers, data, size):
+    # Copies the spooled body in `data` into the cache and rewinds it.
+    global http_cache_size
+    meta = {'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+    if not meta['etag'] and not meta['last_modified']:
+        return
+
+    folder = app.config['HTTP_CACHE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    data_path, meta_path = http_cache_paths(url)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(data_path + suffix, 'wb') as f:
+        shutil.copyfileobj(data, f)
+    data.seek(0)
+    with open(meta_path + suffix, 'w') as f:
+        json.dump(meta, f)
+    os.replace(data_path + suffix, data_path)
+    os.replace(meta_path + suffix, meta_path)
+
+    with http_cache_lock:
+        if http_cache_size is None:
+            http_cache_size = evict_http_cache()
+        else:
+            http_cache_size += size
+            if http_cache_size > app.config['HTTP_CACHE_MAX_BYTES']:
+                http_cache_size = evict_http_cache()
+
+def evict_http_cache():
+    return evict_cache_folder(app.config['HTTP_CACHE_FOLDER'], app.config['HTTP_CACHE_MAX_BYTES'], ['.json'])
+
+def evict_cache_folder(folder, budget, sidecar_suffixes=()):
+    # Removes the least recently used .bin files (and their sidecar files) until
+    # the .bin files in `folder` fit in `budget` bytes; returns the size left.
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.bin'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        for stale_path in [path] + [path[:-len('.bin')] + suffix for suffix in sidecar_suffixes]:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+        total -= size
+    return total
+
+def file_sha256(data):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: data.read(1024 * 1024), b''):
+        digest.update(chunk)
+    data.seek(0)
+    return digest.hexdigest()
+
+def output_cache_path(source_digest, stages, output_format, max_bytes):
+    settings = [source_digest, stages, output_format, app.config['OUTPUT_FORMATS'][output_format], max_bytes]
+    key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(app.config['OUTPUT_CACHE_FOLDER'], key + '.bin')
+
+def read_output_cache(path):
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            return Image.open(BytesIO(response.content))
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    os.utime(path)
+    return data
+
+def write_output_cache(path, data):
+    global output_cache_size
+    os.makedirs(app.config['OUTPUT_CACHE_FOLDER'], exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    with output_cache_lock:
+        if output_cache_size is None:
+            output_cache_size = evict_output_cache()
         else:
-            print(f"Failed to download image from URL: {url} with status code {response.status_code}")
-            return None
+            output_cache_size += len(data)
+            if output_cache_size > app.config['OUTPUT_CACHE_MAX_BYTES']:
+                output_cache_size = evict_output_cache()
+
+def evict_output_cache():
+    return evict_cache_folder(app.config['OUTPUT_CACHE_FOLDER'], app.config['OUTPUT_CACHE_MAX_BYTES'])
+
+def fetch_image_file(url, stats):
+    # Returns a file object holding the image body; raises DownloadFailed (or a
+    # requests exception) if this attempt failed.
+    started = time.perf_counter()
+    data, size = fetch_image_file_cached(url, stats)
+    stats.observe('download', time.perf_counter() - started, size)
+    return data
+
+def fetch_image_file_cached(url, stats):
+    meta = read_http_cache_meta(url)
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    if headers:
+        with fetch_url(url, headers=headers, stream=True) as response:
+            if response.status_code != 304:
+                return read_image_response(url, response, stats)
+            data = open_http_cache_data(url)
+            if data is not None:
+                size = os.fstat(data.fileno()).st_size
+                stats.incr('cache_hits')
+                stats.incr('cache_bytes_saved', size)
+                return data, size
+
+    with fetch_url(url, stream=True) as response:
+        return read_image_response(url, response, stats)
+
+def read_image_response(url, response, stats):
+    if response.status_code in RETRY_STATUS_CODES:
+        raise DownloadThrottled(f"status code {response.status_code}", parse_retry_after(response.headers.get('Retry-After')))
+    if response.status_code != 200:
+        raise DownloadFailed(f"status code {response.status_code}")
+    stats.incr('cache_misses')
+    data, size = read_response(response)
+    write_http_cache(url, response.headers, data, size)
+    return data, size
+
+def download_image(url, stats=None):
+    # One download attempt. Returns (image, downloaded file, sha256 of its
+    # bytes); the image is opened lazily from the file, which is kept for
+    # pass-through. Raises DownloadThrottled or a requests connection error when
+    # the attempt is worth retrying, and any other exception when it is not.
+    stats = stats or JobStats()
+    data = fetch_image_file(url, stats)
+    digest = file_sha256(data)
+    image = Image.open(data)
+    if image.width * image.height > app.config['DOWNLOAD_MAX_PIXELS']:
+        raise DownloadRejected(f"{image.width}x{image.height} is over the {app.config['DOWNLOAD_MAX_PIXELS']} pixel limit")
+    return image, data, digest
+
+def decoded_size(image):
+    return image.width * image.height * len(image.getbands())
+
+def iter_completed(executor, calls, limit):
+    # calls is an iterable of (key, fn, *args); yields (key, result) as each call finishes,
+    # keeping at most `limit` calls queued so large CSVs do not pile up futures.
+    pending = {}
+    for key, fn, *args in calls:
+        pending[executor.submit(fn, *args)] = key
+        if len(pending) >= limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future.result()
+
+def download_images(items, stats):
+    # items is an iterable of (key, url); yields (key, url, (image, file, digest), None)
+    # for each row that downloads and (key, url, None, reason) for each row that
+    # does not. Rows wait in per-host queues until their host's HostLimiter has
+    # room, so a throttled host only slows down its own rows, and retries are
+    # requeued with a not-before time instead of sleeping in a download thread.
+    workers = app.config['DOWNLOAD_WORKERS']
+    retries = app.config['DOWNLOAD_RETRIES']
+    queue_deadline = app.config['DOWNLOAD_QUEUE_DEADLINE']
+    max_queued = app.config['DOWNLOAD_MAX_QUEUED']
+    items = iter(items)
+    queues = {}
+    queued = 0
+    running = {}
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Only rows a host can take now count towards the read-ahead, so a
+            # paused or saturated host does not stop rows for others being read.
+            ready = sum(len(queue) for host, queue in queues.items() if not get_host_limit(host).blocked())
+            while not exhausted and ready < workers * 4 and queued < max_queued:
+                try:
+                    key, url = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                host = url_host(url)
+                queues.setdefault(host, deque()).append((0, 0, key, url, time.monotonic()))
+                queued += 1
+                if not get_host_limit(host).blocked():
+                    ready += 1
+
+            if exhausted and not queued and not running:
+                break
+
+            now = time.monotonic()
+            expired = []
+            for host, queue in queues.items():
+                if get_host_limit(host).paused() and any(now - entry[4] > queue_deadline for entry in queue):
+                    expired.extend(entry for entry in queue if now - entry[4] > queue_deadline)
+                    kept = [entry for entry in queue if now - entry[4] <= queue_deadline]
+                    queue.clear()
+                    queue.extend(kept)
+            for _, attempt, key, url, _ in expired:
+                queued -= 1
+                print(f"Gave up on image URL: {url} after waiting {queue_deadline}s for its host")
+                yield key, url, None, f"waited over {queue_deadline}s for the host after {attempt} attempts"
+
+            next_ready = now + 0.05
+            for host, queue in queues.items():
+                limiter = get_host_limit(host)
+                for _ in range(len(queue)):
+                    if len(running) >= workers:
+                        break
+                    not_before, attempt, key, url, queued_at = queue[0]
+                    if not_before > now:
+                        queue.rotate(-1)
+                        next_ready = min(next_ready, not_before)
+                        continue
+                    if not limiter.try_acquire():
+                        break
+                    queue.popleft()
+                    queued -= 1
+                    running[executor.submit(download_image, url, stats)] = (host, attempt, key, url, queued_at, time.monotonic())
+
+            queues = {host: queue for host, queue in queues.items() if queue}
+            if not running:
+                time.sleep(max(0, next_ready - time.monotonic()))
+                continue
+
+            done, _ = wait(running, timeout=max(0, next_ready - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                host, attempt, key, url, queued_at, started = running.pop(future)
+                limiter = get_host_limit(host)
+                latency = time.monotonic() - started
+                try:
+                    result = future.result()
+                except (DownloadThrottled, requests.ConnectionError, requests.Timeout) as e:
+                    retry_after = getattr(e, 'retry_after', None)
+                    retry = attempt < retries and (retry_after or 0) <= app.config['DOWNLOAD_MAX_RETRY_AFTER']
+                    # A Retry-After the row will not wait for must not pause the host for everyone else.
+                    limiter.release(latency, congested=True, retry_after=retry_after if retry else None)
+                    if retry:
+                        stats.incr('download_retries')
+                        not_before = time.monotonic() + backoff_delay(attempt, retry_after)
+                        queues.setdefault(host, deque()).append((not_before, attempt + 1, key, url, queued_at))
+                        queued += 1
+                        continue
+                    print(f"Failed to download image from URL: {url} after {attempt + 1} attempts: {e}")
+                    yield key, url, None, f"{e} after {attempt + 1} attempts"
+                except Exception as e:
+                    limiter.release(latency)
+                    if isinstance(e, DownloadRejected):
+                        stats.incr('downloads_rejected')
+                    print(f"Error occurred while downloading image from URL: {url}\n{e}")
+                    yield key, url, None, str(e)
+                else:
+                    limiter.release(latency)
+                    yield key, url, result, None
+
+def normalize_column_name(name):
+    return ' '.join(str(name).split()).casefold()
+
+def resolve_image_columns(header):
+    # Returns {column: index in header} for each IMAGE_COLUMN_ALIASES column found.
+    positions = {normalize_column_name(name): index for index, name in reversed(list(enumerate(header)))}
+    columns = {}
+    for column, aliases in app.config['IMAGE_COLUMN_ALIASES'].items():
+        for alias in aliases:
+            if normalize_column_name(alias) in positions:
+                columns[column] = positions[normalize_column_name(alias)]
+                break
+    return columns
+
+def open_image_csv(csv_path):
+    return open(csv_path, newline='', encoding='utf-8-sig', errors='replace')
+
+def image_csv_error(csv_path):
+    # Returns a message for the user if the CSV cannot be used, else None.
+    try:
+        with open_image_csv(csv_path) as f:
+            header = next(csv.reader(f), [])
     except Exception as e:
-        print(f"Error occurred while downloading image from URL: {url}\n{e}")
-        return None
+        return f"Error reading the CSV file: {e}"
+    if len(resolve_image_columns(header)) < len(app.config['IMAGE_COLUMN_ALIASES']):
+        return "'Image link' or 'Image Name' column not found in the CSV file."
+    return None
 
-def process_images(df, option, width=None, height=None):
-    if not os.path.exists(PROCESSED_FOLDER):
-        os.makedirs(PROCESSED_FOLDER)
-    
-    for index, row in df.iterrows():
-        url = row['Image link']
-        image_name = row['Image Name']
-        
-        if pd.notna(url) and pd.notna(image_name) and is_valid_url(url):
-            image = download_image(url)
-            if image:
-                processed_image = process_image(image, option, width, height)
-                processed_image.convert('RGB').save(os.path.join(PROCESSED_FOLDER, f"{image_name}.jpg"), "JPEG", quality=95)
-                print(f"Image '{image_name}' processed and saved successfully.")
+def iter_image_rows(csv_path, stats):
+    # Yields (image_name, url) for each valid row while the CSV is being read.
+    with open_image_csv(csv_path) as f:
+        reader = csv.reader(f)
+        columns = resolve_image_columns(next(reader, []))
+        link_index, name_index = columns['Image link'], columns['Image Name']
+        index = 0
+        for row in reader:
+            if not any(value.strip() for value in row):
+                continue
+            index += 1
+            stats.incr('rows_total')
+            url = row[link_index].strip() if link_index < len(row) else ''
+            image_name = row[name_index].strip() if name_index < len(row) else ''
+            if url and image_name and is_valid_url(url):
+                yield image_name, url
+            else:
+                print(f"Invalid or missing URL or image name for row {index}. Skipping this row.")
+                stats.fail(image_name, url, f"invalid or missing URL or image name in row {index}")
+
+def save_image(image, pil_format, options):
+    buffer = BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+def encode_image(image, output_format='jpeg', max_bytes=None):
+    pil_format, _, options = app.config['OUTPUT_FORMATS'][output_format]
+    image = image.convert('RGB')
+    data = save_image(image, pil_format, options)
+    if max_bytes is None or len(data) <= max_bytes:
+        return data
+
+    # Highest quality that fits the budget, or the lowest allowed quality if none does.
+    low, high = app.config['OUTPUT_MIN_QUALITY'], options['quality'] - 1
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = save_image(image, pil_format, dict(options, quality=quality))
+        if len(candidate) <= max_bytes:
+            best, low = candidate, quality + 1
         else:
-            print(f"Invalid or missing URL or image name for row {index + 1}. Skipping this row.")
-
-def process_image(image, option, width=None, height=None):
-    if option == 'original':
-        return image.convert('RGB')
-    elif option == 'background_remove':
-        removed_bg_image = Image.open(BytesIO(rembg.remove(image_to_bytes(image))))
-        return add_white_background(removed_bg_image)
+            high = quality - 1
+    return best or save_image(image, pil_format, dict(options, quality=app.config['OUTPUT_MIN_QUALITY']))
+
+def output_extension(output_format):
+    return app.config['OUTPUT_FORMATS'][output_format][1]
+
+def passthrough_allowed(image, stages, output_format, source_size, max_bytes=None):
+    if output_format not in app.config['PASSTHROUGH_FORMATS']:
+        return False
+    if image.format != app.config['OUTPUT_FORMATS'][output_format][0] or image.mode not in ('RGB', 'L'):
+        return False
+    if max_bytes is not None and source_size > max_bytes:
+        return False
+    for name, argument in stages:
+        if name != 'resize':
+            return False
+        width, height, fit_mode = argument
+        output_size, box = resize_geometry(image.size, width, height, fit_mode)
+        if output_size != image.size or box != (0, 0, *image.size):
+            return False
+        if fit_mode == 'pad' and output_size != (width, height):
+            return False
+    return True
+
+def process_and_encode_image(image, stages, stats=None, output_format='jpeg', max_bytes=None):
+    stats = stats or JobStats()
+    with image:
+        image = run_stages(image, stages, stats)
+    started = time.perf_counter()
+    data = encode_image(image, output_format, max_bytes)
+    stats.observe('encode', time.perf_counter() - started, len(data))
+    stats.incr('output_bytes', len(data))
+    if (output_format, max_bytes) != ('jpeg', None) and random.random() < app.config['OUTPUT_BASELINE_SAMPLE_RATE']:
+        stats.incr('sampled_output_bytes', len(data))
+        stats.incr('sampled_baseline_bytes', len(encode_image(image)))
+    return data
+
+def iter_processed_images(items, stages, stats=None, output_format='jpeg', max_bytes=None):
+    # items is an iterable of (image_name, url). Each distinct URL is fetched
+    # once and each distinct image is decoded once, run through `stages` in
+    # memory and encoded once in `output_format`, or written as downloaded when
+    # passthrough_allowed says that would not change it; yields (arcname, image_bytes)
+    # for every row that downloads and processes cleanly, then
+    # FAILED_ROWS_FILENAME listing the rows that did not, if any.
+    #
+    # Everything below except process() runs in the consumer's thread, so the
+    # bookkeeping needs no locks. pending_urls maps a normalized URL being
+    # fetched or processed to the names waiting on it, done_urls remembers
+    # (url, cache_path, reason) for URLs already written, and contents maps the
+    # digest of an image being processed to the URL groups sharing its bytes.
+    stats = stats or JobStats()
+    workers = app.config['PROCESS_WORKERS']
+    extension = output_extension(output_format)
+    budget = ByteBudget(app.config['JOB_INFLIGHT_BYTES'])
+    pending_urls = {}
+    done_urls = OrderedDict()
+    contents = {}
+    finished = deque()
+
+    def process(image, source, passthrough, image_name, size, cache_path):
+        # Returns (image_bytes, None) or (None, reason).
+        try:
+            data = read_output_cache(cache_path)
+            if data is not None:
+                image.close()
+                stats.incr('output_cache_hits')
+                stats.incr('output_bytes', len(data))
+                return data, None
+            if passthrough:
+                source.seek(0)
+                data = source.read()
+                image.close()
+                stats.incr('passthrough')
+                stats.incr('output_bytes', len(data))
+            else:
+                data = process_and_encode_image(image, stages, stats, output_format, max_bytes)
+            stats.incr('output_cache_misses')
+            write_output_cache(cache_path, data)
+            return data, None
+        except Exception as e:
+            print(f"Error occurred while processing image '{image_name}'\n{e}")
+            return None, f"processing failed: {e}"
+        finally:
+            source.close()
+            budget.release(size)
+
+    def finish(group, data, reason, cache_path):
+        pending_urls.pop(group['key'])
+        done_urls[group['key']] = (group['url'], cache_path, reason)
+        if len(done_urls) > app.config['BATCH_DEDUP_MAX_URLS']:
+            done_urls.popitem(last=False)
+        finished.append((group['names'], group['url'], data, reason, cache_path))
+
+    def fetches():
+        for image_name, url in items:
+            key = normalize_url(url)
+            if key in pending_urls:
+                pending_urls[key]['names'].append(image_name)
+                stats.incr('fetches_saved')
+                continue
+            done = done_urls.get(key)
+            if done and (done[2] is not None or os.path.exists(done[1])):
+                done_urls.move_to_end(key)
+                finished.append(([image_name], done[0], None, done[2], done[1]))
+                stats.incr('fetches_saved')
+                continue
+            pending_urls[key] = {'key': key, 'url': url, 'names': [image_name]}
+            yield key, url
+
+    def calls():
+        for key, url, result, reason in download_images(fetches(), stats):
+            group = pending_urls[key]
+            if result is None:
+                finish(group, None, f"download failed: {reason}", None)
+                continue
+            image, source, digest = result
+            if digest in contents:
+                image.close()
+                source.close()
+                contents[digest]['groups'].append(group)
+                stats.incr('processing_runs_saved')
+                continue
+            source_size = source.seek(0, os.SEEK_END)
+            passthrough = passthrough_allowed(image, stages, output_format, source_size, max_bytes)
+            size = source_size if passthrough else decoded_size(image)
+            budget.acquire(size)
+            cache_path = output_cache_path(digest, stages, output_format, max_bytes)
+            contents[digest] = {'groups': [group], 'cache_path': cache_path}
+            yield digest, process, image, source, passthrough, group['names'][0], size, cache_path
+
+    def written():
+        # Yields the ZIP entries for every finished group, reading outputs of
+        # repeats from the output cache.
+        while finished:
+            names, url, data, reason, cache_path = finished.popleft()
+            if data is None and reason is None:
+                data = read_output_cache(cache_path)
+                if data is None:
+                    reason = "processed output was evicted from the cache"
+            for image_name in names:
+                if data is None:
+                    stats.fail(image_name, url, reason)
+                    continue
+                stats.incr('rows_done')
+                print(f"Image '{image_name}' processed and saved successfully.")
+                yield f"{image_name}.{extension}", data
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for digest, (data, reason) in iter_completed(executor, calls(), workers * 2):
+            content = contents.pop(digest)
+            for group in content['groups']:
+                finish(group, data, reason, content['cache_path'] if data is not None else None)
+            yield from written()
+    yield from written()
+
+    failed_rows = stats.failed_rows_csv()
+    if failed_rows:
+        yield FAILED_ROWS_FILENAME, failed_rows
+    print_job_stats(stats)
+
+def build_stages(option, width=None, height=None, model=None, fit_mode='stretch', bg_quality='full'):
+    # Stages are (name, argument) pairs applied in order by run_stages.
+    mask_size = app.config['REMBG_QUALITIES'][bg_quality]
+    if mask_size:
+        background_stage = ('remove_background_fast', (model, mask_size))
+    else:
+        background_stage = ('remove_background', model)
+    if option == 'background_remove':
+        return [background_stage]
     elif option == 'resize':
-        return image.resize((width, height), Image.LANCZOS).convert('RGB')
+        return [('resize', (width, height, fit_mode))]
     elif option == 'resize_background_remove':
-        resized_image = image.resize((width, height), Image.LANCZOS)
-        removed_bg_image = Image.open(BytesIO(rembg.remove(image_to_bytes(resized_image))))
-        return add_white_background(removed_bg_image)
+        return [('resize', (width, height, fit_mode)), background_stage]
     else:
-        return image.convert('RGB')
+        return []
+
+def run_stages(image, stages, stats=None):
+    stats = stats or JobStats()
+    if stages and stages[0][0] == 'resize':
+        draft_for_resize(image, *stages[0][1])
+    started = time.perf_counter()
+    image.load()
+    stats.observe('decode', time.perf_counter() - started)
+
+    for name, argument in stages:
+        started = time.perf_counter()
+        if name == 'resize':
+            image = resize_image(image, *argument)
+        elif name == 'remove_background':
+            image = remove_background(image, argument)
+        elif name == 'remove_background_fast':
+            image = remove_background_fast(image, *argument)
+        stats.observe(name, time.perf_counter() - started)
+    return image.convert('RGB')
+
+def process_image(image, option, width=None, height=None, model=None, fit_mode='stretch', bg_quality='full'):
+    return run_stages(image, build_stages(option, width, height, model, fit_mode, bg_quality))
+
+def resize_geometry(source_size, width, height, fit_mode):
+    # Returns (output_size, source_box): the size to resample to and the part of
+    # the source to resample from. 'stretch' ignores the aspect ratio, 'fit' and
+    # 'pad' fit inside width x height, 'fill' covers it and crops the overflow.
+    source_width, source_height = source_size
+    if fit_mode in ('fit', 'pad'):
+        scale = min(width / source_width, height / source_height)
+        output_size = (max(1, round(source_width * scale)), max(1, round(source_height * scale)))
+        return output_size, (0, 0, source_width, source_height)
+    if fit_mode == 'fill':
+        scale = max(width / source_width, height / source_height)
+        crop_width, crop_height = width / scale, height / scale
+        left, top = (source_width - crop_width) / 2, (source_height - crop_height) / 2
+        return (width, height), (left, top, left + crop_width, top + crop_height)
+    return (width, height), (0, 0, source_width, source_height)
+
+def draft_for_resize(image, width, height, fit_mode='stretch'):
+    # JPEGs that have not been decoded yet are decoded at a reduced scale (DCT
+    # scaling via draft) that is still RESIZE_REDUCING_GAP times the output size.
+    # Has no effect on other formats or on images that are already loaded.
+    gap = app.config['RESIZE_REDUCING_GAP']
+    output_size, box = resize_geometry(image.size, width, height, fit_mode)
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    draft_scale = min(1, max(output_size[0] * gap / box_width, output_size[1] * gap / box_height))
+    image.draft(image.mode, (int(image.size[0] * draft_scale), int(image.size[1] * draft_scale)))
+
+def reducing_gap(image):
+    # Pillow cannot reduce() 16-bit modes (I;16*, e.g. 16-bit grayscale PNGs);
+    # those are resized in a single pass.
+    return None if image.mode.startswith('I;16') else app.config['RESIZE_REDUCING_GAP']
+
+def resize_image(image, width, height, fit_mode='stretch'):
+    # Drafts the image (see draft_for_resize), then reduces it in integer steps
+    # before the final LANCZOS pass.
+    full_size = image.size
+    output_size, box = resize_geometry(full_size, width, height, fit_mode)
+    draft_for_resize(image, width, height, fit_mode)
+    if image.size != full_size:
+        x_scale, y_scale = image.size[0] / full_size[0], image.size[1] / full_size[1]
+        box = (box[0] * x_scale, box[1] * y_scale, box[2] * x_scale, box[3] * y_scale)
+
+    resized = image.resize(output_size, Image.LANCZOS, box=box, reducing_gap=reducing_gap(image))
+    if fit_mode != 'pad':
+        return resized
+
+    if resized.mode not in ('RGB', 'RGBA'):
+        resized = resized.convert('RGBA' if resized.has_transparency_data else 'RGB')
+    canvas = Image.new(resized.mode, (width, height), 'white')
+    canvas.paste(resized, ((width - output_size[0]) // 2, (height - output_size[1]) // 2))
+    return canvas
 
 def image_to_bytes(image):
     img_byte_arr = BytesIO()
@@ -85,6 +1132,113 @@ def add_white_background(image):
     white_bg.paste(image, (0, 0), image)
     return white_bg.convert("RGB")
 
+rembg_lock = threading.Lock()
+rembg_pool = None
+rembg_sessions = {}
+rembg_worker_sess_opts = None
+
+def get_rembg_session(model_name, sess_opts=None):
+    with rembg_lock:
+        if model_name not in rembg_sessions:
+            rembg_sessions[model_name] = rembg.new_session(model_name, sess_opts=sess_opts)
+        return rembg_sessions[model_name]
+
+def single_threaded_session_options():
+    import onnxruntime
+    sess_opts = onnxruntime.SessionOptions()
+    sess_opts.intra_op_num_threads = 1
+    sess_opts.inter_op_num_threads = 1
+    return sess_opts
+
+def preload_rembg_models(model_names):
+    # Loads the models in this process and switches background removal to run
+    # in-process. Called from gunicorn.conf.py in the master before workers are
+    # forked, so every worker shares one copy-on-write copy of the weights.
+    # Sessions are single threaded: onnxruntime thread pools do not survive fork.
+    sess_opts = single_threaded_session_options()
+    app.config['REMBG_WORKERS'] = 0
+    for model_name in model_names:
+        get_rembg_session(model_name, sess_opts)
+        print(f"Preloaded background removal model: {model_name}")
+
+def rembg_worker_init(model_name):
+    # Pool workers run in parallel with each other, so each one gets a single
+    # onnxruntime thread instead of a thread pool the size of the machine.
+    global rembg_worker_sess_opts
+    rembg_worker_sess_opts = single_threaded_session_options()
+    get_rembg_session(model_name, rembg_worker_sess_opts)
+
+def rembg_worker_session(model_name):
+    return get_rembg_session(model_name, rembg_worker_sess_opts)
+
+def rembg_worker_remove(image_bytes, model_name):
+    return rembg.remove(image_bytes, session=rembg_worker_session(model_name))
+
+def rembg_worker_mask(image_bytes, model_name):
+    return rembg.remove(image_bytes, session=rembg_worker_session(model_name), only_mask=True)
+
+def child_processes_allowed():
+    # Daemonic processes (e.g. Celery prefork workers) cannot start process pools.
+    return not multiprocessing.current_process().daemon
+
+def get_rembg_pool():
+    global rembg_pool
+    with rembg_lock:
+        if rembg_pool is None:
+            rembg_pool = ProcessPoolExecutor(
+                max_workers=app.config['REMBG_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=rembg_worker_init,
+                initargs=(app.config['REMBG_MODEL'],),
+            )
+        return rembg_pool
+
+def run_rembg(worker, image_bytes, model_name):
+    model_name = model_name or app.config['REMBG_MODEL']
+    if model_name not in app.config['REMBG_MODELS']:
+        raise ValueError(f"Unknown background removal model: {model_name}")
+
+    if app.config['REMBG_WORKERS'] == 0 or not child_processes_allowed():
+        return worker(image_bytes, model_name)
+    global rembg_pool
+    pool = get_rembg_pool()
+    try:
+        return pool.submit(worker, image_bytes, model_name).result()
+    except BrokenProcessPool:
+        with rembg_lock:
+            if rembg_pool is pool:
+                rembg_pool = None
+        raise
+
+def remove_background(image, model_name=None):
+    output = run_rembg(rembg_worker_remove, image_to_bytes(image), model_name)
+    return add_white_background(Image.open(BytesIO(output)))
+
+# Stretches the soft band an upsampled mask gets at its edges back to the
+# sharpness of a full-size mask, and drops the faint halo around the subject.
+MASK_EDGE_LUT = [min(255, max(0, round((value - 16) * 255 / 223))) for value in range(256)]
+
+def background_mask(image, model_name=None, mask_size=None):
+    # Returns the foreground mask ('L', same size as image), inferred on a copy
+    # no larger than mask_size on its longer side.
+    small = image
+    scale = mask_size / max(image.size) if mask_size else 1
+    if scale < 1:
+        small_size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        small = image.resize(small_size, Image.BILINEAR, reducing_gap=reducing_gap(image))
+    if small.mode not in ('RGB', 'RGBA'):
+        small = small.convert('RGBA' if small.has_transparency_data else 'RGB')
+
+    output = run_rembg(rembg_worker_mask, image_to_bytes(small), model_name)
+    mask = Image.open(BytesIO(output)).convert('L')
+    if mask.size != image.size:
+        mask = mask.resize(image.size, Image.BICUBIC).point(MASK_EDGE_LUT)
+    return mask
+
+def remove_background_fast(image, model_name=None, mask_size=512):
+    mask = background_mask(image, model_name, mask_size)
+    return Image.composite(image.convert('RGB'), Image.new('RGB', image.size, 'white'), mask)
+
 @app.route('/')
 def HOME():
     return render_template('index.html')
@@ -93,6 +1247,8 @@ def HOME():
 def index():
     return render_template('imagedownloder.html')
 
+UPLOAD_OPTIONS = ['original', 'background_remove', 'resize', 'resize_background_remove']
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files or request.files['file'].filename == '':
@@ -100,121 +1256,327 @@ def upload_file():
 
     file = request.files['file']
     if file:
-        file_path = os.path.join(UPLOAD_FOLDER, file.filename)
+        option = request.form.get('option') or 'original'
+        if option not in UPLOAD_OPTIONS:
+            return f"Unknown option: {option}"
+
+        job_id = create_job('upload', option)
+        file_path = os.path.join(job_folder(job_id), 'upload.csv')
         file.save(file_path)
         
-        try:
-            df = pd.read_csv(file_path)
-        except Exception as e:
-            return f"Error reading the CSV file: {e}"
-        
-        if 'Image link' not in df.columns or 'Image Name' not in df.columns:
-            return "'Image link' or 'Image Name' column not found in the CSV file."
+        error = image_csv_error(file_path)
+        if error:
+            return error
 
-        option = request.form.get('option')
         width = int(request.form.get('width')) if request.form.get('width') else None
         height = int(request.form.get('height')) if request.form.get('height') else None
 
         if option in ['resize', 'resize_background_remove'] and (width is None or height is None):
             return "Width and Height are required for resizing."
 
-        process_images(df, option, width, height)
+        model = request.form.get('model') or app.config['REMBG_MODEL']
+        if model not in app.config['REMBG_MODELS']:
+            return f"Unknown background removal model: {model}"
+
+        fit_mode = request.form.get('fit_mode') or 'stretch'
+        if fit_mode not in app.config['RESIZE_FIT_MODES']:
+            return f"Unknown resize mode: {fit_mode}"
 
-        zip_filename = "processed_images.zip"
-        zip_path = os.path.join(PROCESSED_FOLDER, zip_filename)
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, dirs, files in os.walk(PROCESSED_FOLDER):
-                for file in files:
-                    if file != zip_filename:
-                        zipf.write(os.path.join(root, file), file)
+        output_format = request.form.get('output_format') or 'jpeg'
+        if output_format not in app.config['OUTPUT_FORMATS']:
+            return f"Unknown output format: {output_format}"
+        try:
+            max_kb = int(request.form.get('max_kb')) if request.form.get('max_kb') else None
+        except ValueError:
+            max_kb = 0
+        if max_kb is not None and max_kb < 1:
+            return "Maximum file size must be a whole number of KB, at least 1."
+        max_bytes = max_kb * 1024 if max_kb else None
 
-        return redirect(url_for('download_zip', filename=zip_filename))
+        bg_quality = request.form.get('bg_quality') or 'full'
+        if bg_quality not in app.config['REMBG_QUALITIES']:
+            return f"Unknown background removal quality: {bg_quality}"
 
-@app.route('/download/<filename>')
-def download_zip(filename):
-    return send_file(os.path.join(PROCESSED_FOLDER, filename), as_attachment=True)
+        args = (file_path, option, width, height, model, fit_mode, output_format, max_bytes, bg_quality)
+        if form_flag('async'):
+            run_upload_job.delay(job_id, *args)
+            return job_submitted(job_id)
 
-def download_dropbox_images(csv_file_path):
-    df = pd.read_csv(csv_file_path)
-    image_paths = []
+        if form_flag('stream'):
+            return stream_job(job_id, iter_upload_job_images, UPLOAD_ZIP_FILENAME, *args)
 
-    if not os.path.exists(DROPBOX_TEMP_FOLDER):
-        os.makedirs(DROPBOX_TEMP_FOLDER)
+        run_upload_job(job_id, *args)
+        return job_response(job_id)
 
-    for index, row in df.iterrows():
-        image_url = row['Image link']
+def iter_upload_job_images(csv_path, option, width, height, model, fit_mode, output_format, max_bytes, bg_quality,
+                           stats):
+    stages = build_stages(option, width, height, model, fit_mode, bg_quality)
+    yield from iter_processed_images(iter_image_rows(csv_path, stats), stages, stats, output_format, max_bytes)
 
-        if 'dropbox.com' in image_url:
-            image_url = image_url.replace('?dl=0', '?raw=1').replace('?rlkey', '?raw=1&rlkey')
+app.config['DROPBOX_RESIZE_SIZE'] = (800, 800)
 
-        try:
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()
-
-            image_name = row['Image Name']
-            image_path = os.path.join(DROPBOX_TEMP_FOLDER, image_name + ".jpg")
-
-            with Image.open(BytesIO(response.content)) as img:
-                img.convert('RGB').save(image_path, 'JPEG', quality=95)
-
-            image_paths.append(image_path)
-
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to download {image_url}: {e}")
-
-    return image_paths
-
-def resize_dropbox_image(image_path, size):
-    with Image.open(image_path) as img:
-        img = img.resize(size, Image.LANCZOS).convert('RGB')
-        img.save(image_path, 'JPEG', quality=95)
-
-def remove_dropbox_background(image_path):
-    with Image.open(image_path) as img:
-        img = remove(img)
-        img = add_white_background(img)
-        img.convert('RGB').save(image_path, 'JPEG', quality=95)
-
-def process_dropbox_images(image_paths, action):
-    for image_path in image_paths:
-        if action == 'resize':
-            resize_dropbox_image(image_path, (800, 800))
-        elif action == 'remove_bg':
-            remove_dropbox_background(image_path)
-        elif action == 'resize_remove_bg':
-            resize_dropbox_image(image_path, (800, 800))
-            remove_dropbox_background(image_path)
-
-def create_dropbox_zip_file(image_paths):
-    zip_file_path = os.path.join(DROPBOX_TEMP_FOLDER, DROPBOX_ZIP_FILENAME)
-    with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-        for image_path in image_paths:
-            zipf.write(image_path, os.path.basename(image_path))
-    return zip_file_path
+DROPBOX_ACTION_OPTIONS = {
+    'download': 'original',
+    'resize': 'resize',
+    'remove_bg': 'background_remove',
+    'resize_remove_bg': 'resize_background_remove',
+}
+
+def dropbox_direct_url(image_url):
+    if 'dropbox.com' in image_url:
+        image_url = image_url.replace('?dl=0', '?raw=1').replace('?rlkey', '?raw=1&rlkey')
+    return image_url
+
+def iter_dropbox_images(csv_file_path, action, model=None, width=None, height=None, fit_mode='stretch',
+                        output_format='jpeg', max_bytes=None, bg_quality='full', stats=None):
+    stats = stats or JobStats()
+    items = ((image_name, dropbox_direct_url(image_url)) for image_name, image_url in iter_image_rows(csv_file_path, stats))
+    width, height = width or app.config['DROPBOX_RESIZE_SIZE'][0], height or app.config['DROPBOX_RESIZE_SIZE'][1]
+    stages = build_stages(DROPBOX_ACTION_OPTIONS.get(action, 'original'), width, height, model, fit_mode, bg_quality)
+    yield from iter_processed_images(items, stages, stats, output_format, max_bytes)
 
 @app.route('/dropbox', methods=['GET', 'POST'])
 def dropbox():
     if request.method == 'POST':
         csv_file = request.files['csv_file']
         action = request.form['action']
+        if action not in DROPBOX_ACTION_OPTIONS:
+            return f"Unknown action: {action}"
+        model = request.form.get('model') or app.config['REMBG_MODEL']
+        if model not in app.config['REMBG_MODELS']:
+            return f"Unknown background removal model: {model}"
+        width = int(request.form.get('width')) if request.form.get('width') else None
+        height = int(request.form.get('height')) if request.form.get('height') else None
+        fit_mode = request.form.get('fit_mode') or 'stretch'
+        if fit_mode not in app.config['RESIZE_FIT_MODES']:
+            return f"Unknown resize mode: {fit_mode}"
+        output_format = request.form.get('output_format') or 'jpeg'
+        if output_format not in app.config['OUTPUT_FORMATS']:
+            return f"Unknown output format: {output_format}"
+        try:
+            max_kb = int(request.form.get('max_kb')) if request.form.get('max_kb') else None
+        except ValueError:
+            max_kb = 0
+        if max_kb is not None and max_kb < 1:
+            return "Maximum file size must be a whole number of KB, at least 1."
+        max_bytes = max_kb * 1024 if max_kb else None
+        bg_quality = request.form.get('bg_quality') or 'full'
+        if bg_quality not in app.config['REMBG_QUALITIES']:
+            return f"Unknown background removal quality: {bg_quality}"
 
-        csv_file_path = os.path.join(DROPBOX_TEMP_FOLDER, 'temp.csv')
+        job_id = create_job('dropbox', action)
+        csv_file_path = os.path.join(job_folder(job_id), 'temp.csv')
         csv_file.save(csv_file_path)
+        error = image_csv_error(csv_file_path)
+        if error:
+            return error
 
-        image_paths = download_dropbox_images(csv_file_path)
-
-        if action != 'download':
-            process_dropbox_images(image_paths, action)
+        args = (csv_file_path, action, model, width, height, fit_mode, output_format, max_bytes, bg_quality)
+        if form_flag('async'):
+            run_dropbox_job.delay(job_id, *args)
+            return job_submitted(job_id)
 
-        zip_file_path = create_dropbox_zip_file(image_paths)
+        if form_flag('stream'):
+            return stream_job(job_id, iter_dropbox_images, DROPBOX_ZIP_FILENAME, *args)
 
-        return send_file(zip_file_path, as_attachment=True, download_name=DROPBOX_ZIP_FILENAME)
+        run_dropbox_job(job_id, *args)
+        return job_response(job_id)
 
     return render_template('dropbox.html')
 
 celery = Celery(__name__)
 celery.conf.broker_url = 'redis://localhost:6379/0'
 
+# Jobs: every /upload, /dropbox and /pdfimage request gets its own folder under
+# JOBS_FOLDER. Each route's pipeline is a generator of (arcname, bytes) that is
+# written straight into the job's ZIP, either inline, as a Celery task when the
+# form is submitted with async=1, or streamed to the client as it is built when
+# submitted with stream=1. Set CELERY_TASK_ALWAYS_EAGER=1 to run tasks
+# in-process with an in-memory broker, e.g. for local testing.
+if os.environ.get('CELERY_TASK_ALWAYS_EAGER') == '1':
+    celery.conf.broker_url = 'memory://'
+    celery.conf.task_always_eager = True
+
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+def job_folder(job_id):
+    return os.path.join(app.config['JOBS_FOLDER'], job_id)
+
+def create_job(kind, option=None):
+    job_id = uuid.uuid4().hex
+    os.makedirs(job_folder(job_id))
+    write_job_status(job_id, {'kind': kind, 'option': option, 'state': 'queued', 'created_at': time.time()})
+    return job_id
+
+def write_job_status(job_id, status):
+    status_path = os.path.join(job_folder(job_id), 'status.json')
+    tmp_path = f"{status_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, status_path)
+
+def read_job_status(job_id):
+    try:
+        with open(os.path.join(job_folder(job_id), 'status.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class ZipStream:
+    # Write-only, unseekable file object for zipfile.ZipFile; whatever the ZIP
+    # writer has produced so far is handed back by drain().
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def unique_entries(outputs):
+    # Rows that repeat an Image Name used to overwrite one file, so the ZIP gets
+    # a single entry per name too: later ones are dropped, not added as duplicates.
+    written = set()
+    for arcname, data in outputs:
+        if arcname in written:
+            print(f"Skipping duplicate file name in ZIP: {arcname}")
+            continue
+        written.add(arcname)
+        yield arcname, data
+
+def write_zip(zip_path, outputs, stats=None):
+    stats = stats or JobStats()
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for arcname, data in unique_entries(outputs):
+            started = time.perf_counter()
+            zipf.writestr(arcname, data)
+            stats.observe('archive', time.perf_counter() - started, len(data))
+    return zip_path
+
+def stream_zip(outputs, stats=None):
+    stats = stats or JobStats()
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w') as zipf:
+        for arcname, data in unique_entries(outputs):
+            started = time.perf_counter()
+            zipf.writestr(arcname, data)
+            stats.observe('archive', time.perf_counter() - started, len(data))
+            yield stream.drain()
+    yield stream.drain()
+
+def run_job(job_id, outputs, zip_filename, *args):
+    stats = JobStats(job_id)
+    stats.save(force=True, state='running')
+    try:
+        write_zip(os.path.join(job_folder(job_id), zip_filename), outputs(*args, stats), stats)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        stats.save(force=True, state='failed', error=str(e))
+        return
+    stats.save(force=True, state='done', result=zip_filename)
+
+def stream_job(job_id, outputs, zip_filename, *args):
+    def generate():
+        stats = JobStats(job_id)
+        stats.save(force=True, state='running')
+        try:
+            yield from stream_zip(outputs(*args, stats), stats)
+        except GeneratorExit:
+            stats.save(force=True, state='cancelled')
+            raise
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            stats.save(force=True, state='failed', error=str(e))
+            raise
+        stats.save(force=True, state='done')
+
+    headers = {'Content-Disposition': f'attachment; filename={zip_filename}'}
+    return Response(generate(), mimetype='application/zip', headers=headers)
+
+@celery.task
+def run_upload_job(job_id, csv_path, option, width=None, height=None, model=None, fit_mode='stretch',
+                   output_format='jpeg', max_bytes=None, bg_quality='full'):
+    run_job(job_id, iter_upload_job_images, UPLOAD_ZIP_FILENAME, csv_path, option, width, height, model, fit_mode,
+            output_format, max_bytes, bg_quality)
+
+@celery.task
+def run_dropbox_job(job_id, csv_file_path, action, model=None, width=None, height=None, fit_mode='stretch',
+                    output_format='jpeg', max_bytes=None, bg_quality='full'):
+    run_job(job_id, iter_dropbox_images, DROPBOX_ZIP_FILENAME, csv_file_path, action, model, width, height, fit_mode,
+            output_format, max_bytes, bg_quality)
+
+@celery.task
+def run_pdf_job(job_id, pdf_path):
+    run_job(job_id, iter_pdf_images, PDF_ZIP_FILENAME, pdf_path)
+
+@celery.task
+def run_pdf_pages_job(job_id, pdf_path, page_ranges, dpi, page_format):
+    run_job(job_id, iter_pdf_pages, PDF_PAGES_ZIP_FILENAME, pdf_path, page_ranges, dpi, page_format)
+
+def form_flag(name):
+    return request.form.get(name) in ('1', 'true', 'on')
+
+def job_submitted(job_id):
+    return jsonify(job_id=job_id, status_url=url_for('job_status', job_id=job_id)), 202
+
+def job_response(job_id):
+    status = read_job_status(job_id)
+    if status['state'] != 'done':
+        return f"Error processing the file: {status.get('error')}"
+    return redirect(url_for('download_job_result', job_id=job_id))
+
+def get_job_status_or_404(job_id):
+    status = read_job_status(job_id) if JOB_ID_PATTERN.fullmatch(job_id) else None
+    if status is None:
+        abort(404)
+    return status
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = get_job_status_or_404(job_id)
+    counts = status.get('counts', {})
+    total = counts.get('rows_total', 0)
+    done = counts.get('rows_done', 0)
+    failed = counts.get('rows_failed', 0)
+    response = {
+        'job_id': job_id,
+        'kind': status.get('kind'),
+        'state': status.get('state'),
+        'rows_total': total,
+        'rows_done': done,
+        'rows_failed': failed,
+        'rows_remaining': max(total - done - failed, 0),
+        'stats': counts,
+        'stages': status.get('stages', {}),
+    }
+    if counts.get('sampled_baseline_bytes'):
+        response['output_saving'] = round(output_saving(counts), 3)
+    if status.get('error'):
+        response['error'] = status['error']
+    if status.get('result'):
+        response['download_url'] = url_for('download_job_result', job_id=job_id)
+    return jsonify(response)
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>/download')
+def download_job_result(job_id):
+    status = get_job_status_or_404(job_id)
+    if not status.get('result'):
+        abort(404)
+    return send_file(os.path.join(job_folder(job_id), status['result']), as_attachment=True)
+
 @celery.task
 def delete_old_files():
     twenty_four_hours_ago = time.time() - (24 * 60 * 60)
@@ -226,6 +1588,20 @@ def delete_old_files():
                 if os.path.getmtime(file_path) < twenty_four_hours_ago:
                     os.remove(file_path)
 
+    if os.path.exists(app.config['JOBS_FOLDER']):
+        for job_id in os.listdir(app.config['JOBS_FOLDER']):
+            folder = job_folder(job_id)
+            if os.path.isdir(folder) and os.path.getmtime(folder) < twenty_four_hours_ago:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    global http_cache_size, output_cache_size
+    if os.path.exists(app.config['HTTP_CACHE_FOLDER']):
+        with http_cache_lock:
+            http_cache_size = evict_http_cache()
+    if os.path.exists(app.config['OUTPUT_CACHE_FOLDER']):
+        with output_cache_lock:
+            output_cache_size = evict_output_cache()
+
 @celery.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(86400, delete_old_files.s(), name='delete old files every 24 hours')
@@ -237,6 +1613,189 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Rows are duplicates when their key columns match an earlier row. Files larger
+# than DEDUP_CHUNK_THRESHOLD bytes are read DEDUP_CHUNK_ROWS rows at a time, with
+# the first MSN of every key seen so far carried over between chunks. Column
+# types are inferred over the whole file in a first pass, so every chunk is
+# matched and written exactly as a whole-file read would be.
+app.config['DEDUP_KEY_COLUMNS'] = ['uom', 'MSN_Description']
+app.config['DEDUP_NORMALIZE_COLUMN'] = 'MSN_Description'
+app.config['DEDUP_CHUNK_THRESHOLD'] = 256 * 1024 * 1024
+app.config['DEDUP_CHUNK_ROWS'] = 500000
+
+# With 'catalog' set, rows are also checked against every earlier upload: the
+# first MSN of each key is kept in a SQLite index at CATALOG_INDEX_PATH, so
+# Duplicate_Of can point at an MSN from a previous batch. Keys are stored as
+# 64-bit hashes and looked up and appended a file (or chunk) at a time, sorted,
+# through a temporary table.
+app.config['CATALOG_INDEX_PATH'] = 'catalog_index.sqlite3'
+
+# Bumped when stored keys change meaning; an index with another version is
+# emptied on first use.
+CATALOG_SCHEMA_VERSION = 4
+
+class CatalogIndex:
+    def __init__(self, path, key_columns, normalize_case=False, normalize_whitespace=False):
+        # Key hashes are mixed with a hash of the key columns and normalization,
+        # so keys built with different settings never match each other.
+        spec = json.dumps([key_columns, normalize_case, normalize_whitespace]).encode('utf-8')
+        self.spec_hash = np.uint64(int.from_bytes(hashlib.sha256(spec).digest()[:8], 'little'))
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('BEGIN IMMEDIATE')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != CATALOG_SCHEMA_VERSION:
+            self.connection.execute('DROP TABLE IF EXISTS catalog')
+            self.connection.execute(f'PRAGMA user_version = {CATALOG_SCHEMA_VERSION}')
+        # upload is the last upload that used the key.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS catalog (key INTEGER PRIMARY KEY, msn, upload INTEGER)')
+        self.connection.execute('COMMIT')
+        self.connection.execute('CREATE TEMP TABLE batch (key INTEGER PRIMARY KEY, msn)')
+        self.upload = random.getrandbits(62)
+
+    def claim(self, keys, msns):
+        # keys is a DataFrame of the new keys, read as text (see dedup_csv) so a
+        # key hashes the same whatever types pandas would have inferred for the
+        # rest of the file, and msns their first MSNs. Returns
+        # (the MSN each key already has in the index, None for keys not seen
+        # before; whether that entry was last used by an earlier upload rather
+        # than an earlier chunk of this one) and records msns for the new keys.
+        # The write lock is held throughout so concurrent uploads cannot both
+        # claim a key.
+        hashes = (pd.util.hash_pandas_object(keys, index=False).to_numpy() ^ self.spec_hash).view(np.int64)
+        order = np.argsort(hashes)
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM batch')
+            connection.executemany('INSERT OR IGNORE INTO batch VALUES (?, ?)',
+                                   zip(hashes[order].tolist(), msns[order].tolist()))
+            earlier = {key: (msn, upload != self.upload) for key, msn, upload in connection.execute(
+                'SELECT batch.key, catalog.msn, catalog.upload FROM batch JOIN catalog ON catalog.key = batch.key')}
+            connection.execute('INSERT INTO catalog SELECT key, msn, ? FROM batch WHERE true '
+                               'ON CONFLICT (key) DO UPDATE SET upload = excluded.upload', (self.upload,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        found = np.empty(len(hashes), dtype=object)
+        previous = np.zeros(len(hashes), dtype=bool)
+        for index, key in enumerate(hashes.tolist()):
+            if key in earlier:
+                found[index], previous[index] = earlier[key]
+        return found, previous
+
+    def close(self):
+        self.connection.close()
+
+def dedup_keys(df, key_columns, normalize_case=False, normalize_whitespace=False):
+    keys = df[key_columns].astype(object)
+    column = app.config['DEDUP_NORMALIZE_COLUMN']
+    if column in key_columns and (normalize_case or normalize_whitespace):
+        values = keys[column].where(keys[column].isna(), keys[column].astype(str))
+        if normalize_whitespace:
+            values = values.str.strip().str.replace(r'\s+', ' ', regex=True)
+        if normalize_case:
+            values = values.str.casefold()
+        keys[column] = values
+    return keys.where(keys.notna(), None)
+
+def mark_duplicates(df, key_columns, seen=None, normalize_case=False, normalize_whitespace=False, catalog=None,
+                    catalog_keys=None):
+    # Adds Unique_Or_Duplicate / Duplicate_Of to df in bulk. `seen` maps keys from
+    # earlier chunks to their first MSN and is updated with this chunk's new keys.
+    # A CatalogIndex then checks the keys still new against earlier uploads,
+    # using catalog_keys (df's key columns read as text, see dedup_csv).
+    # Blanks in numeric key columns never matched anything in the original
+    # row-by-row loop (every row got its own float NaN), so those rows stay
+    # Unique and are left out of the matching.
+    numeric_columns = [column for column in key_columns if df[column].dtype.kind == 'f']
+    matchable = np.ones(len(df), dtype=bool)
+    if numeric_columns:
+        matchable = ~df[numeric_columns].isna().any(axis=1).to_numpy()
+    keys = dedup_keys(df[matchable], key_columns, normalize_case, normalize_whitespace)
+    duplicate = keys.duplicated(keep='first').to_numpy()
+    group_ids = keys.groupby(key_columns, dropna=False, sort=False).ngroup().to_numpy()
+    group_msn = df['MSN'].to_numpy(dtype=object)[matchable][~duplicate]
+
+    group_is_new = np.ones(len(group_msn), dtype=bool)
+    if seen is not None:
+        first_keys = list(keys[~duplicate].itertuples(index=False, name=None))
+        for group_id, key in enumerate(first_keys):
+            if key in seen:
+                group_msn[group_id] = seen[key]
+                group_is_new[group_id] = False
+
+    if catalog is not None:
+        new = np.flatnonzero(group_is_new)
+        first_rows = np.flatnonzero(~duplicate)[new]
+        text_keys = dedup_keys(catalog_keys[key_columns][matchable].iloc[first_rows], key_columns,
+                               normalize_case, normalize_whitespace)
+        earlier, previous = catalog.claim(text_keys, group_msn[new])
+        # A key an earlier upload indexed under this same MSN is a re-upload of that row.
+        found = ~(np.equal(earlier, None) | (previous & np.equal(earlier, group_msn[new])))
+        group_msn[new[found]] = earlier[found]
+        group_is_new[new[found]] = False
+
+    if seen is not None:
+        # Recorded after the catalog lookup, so later chunks point at the same MSN.
+        for group_id, key in enumerate(first_keys):
+            if key not in seen:
+                seen[key] = group_msn[group_id]
+    duplicate = duplicate | ~group_is_new[group_ids]
+
+    unique_or_duplicate = np.full(len(df), 'Unique', dtype=object)
+    unique_or_duplicate[matchable] = np.where(duplicate, 'Duplicate', 'Unique')
+    duplicate_of = np.full(len(df), None, dtype=object)
+    duplicate_of[matchable] = np.where(duplicate, group_msn[group_ids], None)
+    df['Unique_Or_Duplicate'] = unique_or_duplicate
+    df['Duplicate_Of'] = duplicate_of
+    return df
+
+def csv_dtypes(file_path, chunksize):
+    # The dtypes a whole-file read would infer, merged from a chunked pass: on
+    # its own a chunk can come out int where the file has blanks (float) or
+    # text (object) in other chunks, or float where a column is blank throughout.
+    dtypes = {}
+    for chunk in pd.read_csv(file_path, encoding='ISO-8859-1', chunksize=chunksize):
+        for column, dtype in chunk.dtypes.items():
+            if column not in dtypes or dtypes[column] == dtype:
+                dtypes[column] = dtype
+            elif dtypes[column].kind in 'iuf' and dtype.kind in 'iuf':
+                dtypes[column] = np.result_type(dtypes[column], dtype)
+            else:
+                dtypes[column] = np.dtype(object)
+    return dtypes
+
+def dedup_csv(file_path, output_path, key_columns, normalize_case=False, normalize_whitespace=False, stats=None,
+              catalog=None):
+    stats = stats or JobStats()
+    # Keys checked against the catalog index are hashed from the text in the
+    # file, read a second time: inferred types would make '1' and '1.0' match
+    # or not depending on the other values in the column. Matching within the
+    # file and the output are the same with or without the catalog.
+    def read_catalog_keys(**kwargs):
+        return pd.read_csv(file_path, encoding='ISO-8859-1', usecols=key_columns, dtype=str, **kwargs)
+
+    if os.path.getsize(file_path) <= app.config['DEDUP_CHUNK_THRESHOLD']:
+        df = pd.read_csv(file_path, encoding='ISO-8859-1')
+        catalog_keys = read_catalog_keys() if catalog is not None else None
+        started = time.perf_counter()
+        mark_duplicates(df, key_columns, None, normalize_case, normalize_whitespace, catalog, catalog_keys)
+        stats.observe('dedup', time.perf_counter() - started)
+        df.to_csv(output_path, index=False)
+        return
+
+    seen = {}
+    chunksize = app.config['DEDUP_CHUNK_ROWS']
+    chunks = pd.read_csv(file_path, encoding='ISO-8859-1', dtype=csv_dtypes(file_path, chunksize), chunksize=chunksize)
+    key_chunks = read_catalog_keys(chunksize=chunksize) if catalog is not None else itertools.repeat(None)
+    for chunk_num, (chunk, catalog_keys) in enumerate(zip(chunks, key_chunks)):
+        started = time.perf_counter()
+        mark_duplicates(chunk, key_columns, seen, normalize_case, normalize_whitespace, catalog, catalog_keys)
+        stats.observe('dedup', time.perf_counter() - started)
+        chunk.to_csv(output_path, index=False, mode='w' if chunk_num == 0 else 'a', header=chunk_num == 0)
+
 @app.route('/unique')
 def unique():
     return render_template('uniqe.html')
@@ -252,61 +1811,212 @@ def upload_file_unique():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
         file.save(file_path)
         
-        # Process the CSV file
-        df = pd.read_csv(file_path, encoding='ISO-8859-1')
-
-        df['Unique_Or_Duplicate'] = 'Unique'
-        df['Duplicate_Of'] = None
-
-        duplicate_tracker = {}
-
-        for index, row in df.iterrows():
-            identifier = (row['uom'], row['MSN_Description'])
-            if identifier in duplicate_tracker:
-                original_msn = duplicate_tracker[identifier]
-                df.at[index, 'Unique_Or_Duplicate'] = 'Duplicate'
-                df.at[index, 'Duplicate_Of'] = original_msn
-            else:
-                duplicate_tracker[identifier] = row['MSN']
+        key_columns = [column.strip() for column in request.form.get('key_columns', '').split(',') if column.strip()]
+        key_columns = key_columns or app.config['DEDUP_KEY_COLUMNS']
+        columns = pd.read_csv(file_path, encoding='ISO-8859-1', nrows=0).columns
+        missing = [column for column in ['MSN'] + key_columns if column not in columns]
+        if missing:
+            return f"Column(s) {', '.join(missing)} not found in the CSV file."
 
+        normalize_case, normalize_whitespace = form_flag('normalize_case'), form_flag('normalize_whitespace')
+        catalog = None
+        if form_flag('catalog'):
+            catalog = CatalogIndex(app.config['CATALOG_INDEX_PATH'], key_columns, normalize_case, normalize_whitespace)
         output_path = os.path.join(app.config['UPLOAD_FOLDER'], 'output3.csv')
-        df.to_csv(output_path, index=False)
+        try:
+            dedup_csv(file_path, output_path, key_columns, normalize_case, normalize_whitespace,
+                      stats=JobStats(kind='uploadunique'), catalog=catalog)
+        finally:
+            if catalog is not None:
+                catalog.close()
 
         return send_file(output_path, as_attachment=True, download_name='output3.csv')
     
     
 ###########################################################image from pdf #########################################################
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['EXTRACT_FOLDER'] = 'extracted_images_2'
-app.config['ZIP_FOLDER'] = 'zipped_images'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['EXTRACT_FOLDER'], exist_ok=True)
-os.makedirs(app.config['ZIP_FOLDER'], exist_ok=True)
 
-def extract_images_from_pdf(pdf_path, output_folder):
-    pdf_document = fitz.open(pdf_path)
+# Embedded images are written as the encoded bytes PyMuPDF returns, and each
+# xref is extracted once however many pages use it (image_pages.csv in the ZIP
+# lists the pages). PDFs with at least PDF_PARALLEL_MIN_PAGES pages are split
+# into PDF_PAGES_PER_TASK page ranges extracted by PDF_WORKERS processes.
+app.config['PDF_WORKERS'] = os.cpu_count() or 1
+app.config['PDF_PARALLEL_MIN_PAGES'] = 200
+app.config['PDF_PAGES_PER_TASK'] = 20
+
+# mode=pages renders whole pages instead (vector catalogs, scans) at the chosen
+# DPI and format. Selections of at least PDF_RENDER_PARALLEL_MIN_PAGES pages are
+# rendered PDF_RENDER_PAGES_PER_TASK pages at a time by PDF_WORKERS processes,
+# each opening the document once, and written to the ZIP as they finish. Pages
+# that would exceed PDF_RENDER_MAX_PIXELS at the chosen DPI are rendered smaller.
+app.config['PDF_RENDER_DPI'] = 150
+app.config['PDF_RENDER_MAX_DPI'] = 600
+app.config['PDF_RENDER_MAX_PIXELS'] = 40000000
+app.config['PDF_RENDER_PARALLEL_MIN_PAGES'] = 8
+app.config['PDF_RENDER_PAGES_PER_TASK'] = 2
+app.config['PDF_PAGE_FORMATS'] = {
+    'png': ('PNG', 'png', {}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 90}),
+    'webp': ('WEBP', 'webp', {'quality': 85, 'method': 4}),
+}
+
+def scan_pdf_images(pdf_document):
+    # Returns {xref: [first_page, img_index, pages]} in order of first appearance.
+    xrefs = {}
     for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        images = page.get_images(full=True)
-        for img_index, img in enumerate(images):
+        for img_index, img in enumerate(pdf_document.get_page_images(page_num, full=True)):
             xref = img[0]
+            if xref not in xrefs:
+                xrefs[xref] = [page_num + 1, img_index + 1, []]
+            if page_num + 1 not in xrefs[xref][2]:
+                xrefs[xref][2].append(page_num + 1)
+    return xrefs
+
+def extract_pdf_xrefs(pdf_path, xrefs):
+    # xrefs is a list of (xref, filename_stem); returns ([(filename, image_bytes)],
+    # seconds spent extracting) so timings from worker processes reach the job.
+    started = time.perf_counter()
+    images = []
+    with fitz.open(pdf_path) as pdf_document:
+        for xref, stem in xrefs:
             base_image = pdf_document.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_ext = base_image["ext"]
-            image = Image.open(io.BytesIO(image_bytes))
-            image_filename = f"page_{page_num+1}_img_{img_index+1}.{image_ext}"
-            image.save(os.path.join(output_folder, image_filename))
+            if base_image:
+                images.append((f"{stem}.{base_image['ext']}", base_image["image"]))
+    return images, time.perf_counter() - started
+
+def iter_pdf_images(pdf_path, stats=None):
+    # Yields (arcname, image_bytes) for every distinct image embedded in the PDF.
+    stats = stats or JobStats()
+    started = time.perf_counter()
+    pdf_document = fitz.open(pdf_path)
+    page_count = len(pdf_document)
+    stats.incr('rows_total', page_count)
+    xrefs = scan_pdf_images(pdf_document)
+    pdf_document.close()
+    stats.observe('pdf_scan', time.perf_counter() - started)
+
+    pages_per_task = app.config['PDF_PAGES_PER_TASK']
+    tasks = {}
+    for xref, (first_page, img_index, pages) in xrefs.items():
+        task = (first_page - 1) // pages_per_task
+        tasks.setdefault(task, []).append((xref, f"page_{first_page}_img_{img_index}"))
+
+    manifest = io.StringIO()
+    manifest.write("filename,xref,pages\n")
+    filenames = {}
+
+    def extracted(result):
+        images, seconds = result
+        stats.observe('pdf_extraction', seconds, sum(len(image_bytes) for _, image_bytes in images))
+        for image_filename, image_bytes in images:
+            filenames[image_filename.rsplit('.', 1)[0]] = image_filename
             print(f"Saved image: {image_filename}")
+            yield image_filename, image_bytes
+
+    if page_count >= app.config['PDF_PARALLEL_MIN_PAGES'] and child_processes_allowed():
+        with ProcessPoolExecutor(max_workers=app.config['PDF_WORKERS'], mp_context=multiprocessing.get_context('spawn')) as executor:
+            calls = ((task, extract_pdf_xrefs, pdf_path, task_xrefs) for task, task_xrefs in tasks.items())
+            for task, result in iter_completed(executor, calls, app.config['PDF_WORKERS'] * 2):
+                yield from extracted(result)
+    else:
+        for task_xrefs in tasks.values():
+            yield from extracted(extract_pdf_xrefs(pdf_path, task_xrefs))
+    stats.incr('rows_done', page_count)
+    stats.incr('pdf_images', len(filenames))
+    stats.incr('pdf_image_references', sum(len(pages) for _, _, pages in xrefs.values()))
+
+    for xref, (first_page, img_index, pages) in xrefs.items():
+        image_filename = filenames.get(f"page_{first_page}_img_{img_index}")
+        if image_filename:
+            manifest.write(f"{image_filename},{xref},{';'.join(map(str, pages))}\n")
+    yield 'image_pages.csv', manifest.getvalue().encode('utf-8')
+
+def parse_page_ranges(spec):
+    # '1-10,15,20-' -> [[1, 10], [15, 15], [20, None]]; empty means every page.
+    page_ranges = []
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)(?:\s*-\s*(\d*))?', part)
+        if not match:
+            raise ValueError(f"Invalid page range: {part}")
+        start = int(match.group(1))
+        end = start if match.group(2) is None else int(match.group(2)) if match.group(2) else None
+        if start < 1 or (end is not None and end < start):
+            raise ValueError(f"Invalid page range: {part}")
+        page_ranges.append([start, end])
+    return page_ranges or [[1, None]]
+
+def selected_pages(page_ranges, page_count):
+    pages = set()
+    for start, end in page_ranges:
+        pages.update(range(start, min(end or page_count, page_count) + 1))
+    return sorted(pages)
+
+def render_pdf_pages(pdf_document, pages, dpi, page_format):
+    # Returns ([(filename, image_bytes)], seconds) for the given 1-based pages.
+    started = time.perf_counter()
+    pil_format, extension, options = app.config['PDF_PAGE_FORMATS'][page_format]
+    max_pixels = app.config['PDF_RENDER_MAX_PIXELS']
+    images = []
+    for page_num in pages:
+        page = pdf_document[page_num - 1]
+        zoom = dpi / 72
+        if page.rect.width * page.rect.height * zoom * zoom > max_pixels:
+            zoom = (max_pixels / (page.rect.width * page.rect.height)) ** 0.5
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+        del pix
+        images.append((f"page_{page_num}.{extension}", save_image(image, pil_format, options)))
+    return images, time.perf_counter() - started
 
-def create_zip_file(source_folder, zip_filename):
-    if os.path.exists(zip_filename):
-        os.remove(zip_filename)
-    with zipfile.ZipFile(zip_filename, 'w') as zipf:
-        for root, dirs, files in os.walk(source_folder):
-            for file in files:
-                zipf.write(os.path.join(root, file), arcname=file)
-    print(f"Created zip file: {zip_filename}")
+render_document = None
+
+def render_worker_init(pdf_path):
+    global render_document
+    render_document = fitz.open(pdf_path)
+
+def render_worker_pages(pages, dpi, page_format):
+    return render_pdf_pages(render_document, pages, dpi, page_format)
+
+def iter_pdf_pages(pdf_path, page_ranges, dpi, page_format, stats=None):
+    # Yields (arcname, image_bytes) for every selected page, in the order they finish.
+    stats = stats or JobStats()
+    pdf_document = fitz.open(pdf_path)
+    page_count = len(pdf_document)
+    pages = selected_pages(page_ranges, page_count)
+    if not pages:
+        pdf_document.close()
+        raise ValueError(f"No pages selected: the PDF has {page_count} pages.")
+    stats.incr('rows_total', len(pages))
+    pages_per_task = app.config['PDF_RENDER_PAGES_PER_TASK']
+    tasks = [pages[index:index + pages_per_task] for index in range(0, len(pages), pages_per_task)]
+
+    def rendered(result):
+        images, seconds = result
+        stats.observe('pdf_render', seconds, sum(len(image_bytes) for _, image_bytes in images))
+        stats.incr('rows_done', len(images))
+        for image_filename, image_bytes in images:
+            print(f"Rendered page: {image_filename}")
+            yield image_filename, image_bytes
+
+    workers = app.config['PDF_WORKERS']
+    if len(pages) >= app.config['PDF_RENDER_PARALLEL_MIN_PAGES'] and workers > 1 and child_processes_allowed():
+        pdf_document.close()
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=render_worker_init, initargs=(pdf_path,)) as executor:
+            calls = ((index, render_worker_pages, task_pages, dpi, page_format) for index, task_pages in enumerate(tasks))
+            for _, result in iter_completed(executor, calls, workers * 2):
+                yield from rendered(result)
+    else:
+        try:
+            for task_pages in tasks:
+                yield from rendered(render_pdf_pages(pdf_document, task_pages, dpi, page_format))
+        finally:
+            pdf_document.close()
 
 @app.route('/pdfimage', methods=['GET', 'POST'])
 def upload_file_image():
@@ -317,19 +2027,58 @@ def upload_file_image():
         if file.filename == '':
             return redirect(request.url)
         if file:
-            pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
+            mode = request.form.get('mode') or 'images'
+            if mode not in ('images', 'pages'):
+                return f"Unknown mode: {mode}"
+            if mode == 'pages':
+                try:
+                    page_ranges = parse_page_ranges(request.form.get('pages'))
+                except ValueError as e:
+                    return str(e)
+                try:
+                    dpi = int(request.form.get('dpi')) if request.form.get('dpi') else app.config['PDF_RENDER_DPI']
+                except ValueError:
+                    dpi = 0
+                if not 1 <= dpi <= app.config['PDF_RENDER_MAX_DPI']:
+                    return f"DPI must be between 1 and {app.config['PDF_RENDER_MAX_DPI']}."
+                page_format = request.form.get('page_format') or 'png'
+                if page_format not in app.config['PDF_PAGE_FORMATS']:
+                    return f"Unknown page format: {page_format}"
+
+            job_id = create_job('pdfimage', mode)
+            pdf_path = os.path.join(job_folder(job_id), 'upload.pdf')
             file.save(pdf_path)
-            extract_images_from_pdf(pdf_path, app.config['EXTRACT_FOLDER'])
 
-            zip_filename = os.path.join(app.config['ZIP_FOLDER'], 'extracted_images.zip')
-            create_zip_file(app.config['EXTRACT_FOLDER'], zip_filename)
-            return redirect(url_for('download_zip_image', filename='extracted_images.zip'))
-    return render_template('pdf_to_image.html')
+            if mode == 'pages':
+                try:
+                    with fitz.open(pdf_path) as pdf_document:
+                        page_count = len(pdf_document)
+                except Exception as e:
+                    return f"Error reading the PDF: {e}"
+                if not selected_pages(page_ranges, page_count):
+                    return f"No pages selected: the PDF has {page_count} pages."
+
+                args = (pdf_path, page_ranges, dpi, page_format)
+                if form_flag('async'):
+                    run_pdf_pages_job.delay(job_id, *args)
+                    return job_submitted(job_id)
+
+                if form_flag('stream'):
+                    return stream_job(job_id, iter_pdf_pages, PDF_PAGES_ZIP_FILENAME, *args)
 
-@app.route('/downloads/<filename>')
-def download_zip_image(filename):
-    zip_path = os.path.join(app.config['ZIP_FOLDER'], filename)
-    return send_file(zip_path, as_attachment=True)
+                run_pdf_pages_job(job_id, *args)
+                return job_response(job_id)
+
+            if form_flag('async'):
+                run_pdf_job.delay(job_id, pdf_path)
+                return job_submitted(job_id)
+
+            if form_flag('stream'):
+                return stream_job(job_id, iter_pdf_images, PDF_ZIP_FILENAME, pdf_path)
+
+            run_pdf_job(job_id, pdf_path)
+            return job_response(job_id)
+    return render_template('pdf_to_image.html')
     
 if __name__ == "__main__":
     for folder in [UPLOAD_FOLDER, PROCESSED_FOLDER, DROPBOX_TEMP_FOLDER]:
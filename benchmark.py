@@ -0,0 +1,511 @@
+"""Offline throughput benchmark for the /upload, /dropbox, /uploadunique and /pdfimage pipelines.
+
+Serves synthetic images from a local HTTP server, generates CSVs and PDFs of
+the requested size, drives each route through the Flask test client and
+reports rows/sec, per-stage latency percentiles and peak RSS. Every scenario
+runs in its own subprocess so peak RSS is per scenario; the 'startup' scenario
+only imports the app and reports the import time and RSS. The 'bgmask'
+scenario (not run by default, it needs the rembg model) compares full-size
+background removal with the --bg-quality low-resolution mask path on the same
+images and reports the speedup and the mean mask difference. --check-dedup
+also compares /uploadunique output, read whole and in small chunks, with the
+original row-by-row loop on the generated CSV and a few awkward ones.
+
+    python benchmark.py --rows 500 --pages 100
+    python benchmark.py --scenarios bgmask --model u2netp --bg-quality fast
+    python benchmark.py --scenarios uploadunique --unique-rows 20000 --check-dedup
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --compare benchmark_baseline.json
+"""
+import argparse
+import csv
+import functools
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+SCENARIOS = ['startup', 'upload', 'dropbox', 'uploadunique', 'pdfimage', 'bgmask']
+DEFAULT_SCENARIOS = ['startup', 'upload', 'dropbox', 'uploadunique', 'pdfimage']
+
+# (module attribute, stage name) pairs timed by wrapping the attribute.
+STAGE_FUNCTIONS = [
+    ('fetch_image_file', 'download'),
+    ('process_and_encode_image', 'process'),
+    ('resize_image', 'resize'),
+    ('remove_background', 'background_removal'),
+    ('remove_background_fast', 'background_removal_fast'),
+    ('encode_image', 'encode'),
+    ('extract_pdf_xrefs', 'pdf_extraction'),
+    ('render_pdf_pages', 'pdf_render'),
+    ('mark_duplicates', 'dedup'),
+]
+
+IMAGE_CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+IMAGE_VARIANTS = 4
+
+
+@functools.lru_cache(maxsize=256)
+def render_image(seed, width, height, image_format):
+    # Low-frequency noise keeps file sizes close to real photos.
+    noise = Image.effect_noise((max(1, width // 16), max(1, height // 16)), 48 + seed % 32).resize((width, height), Image.BICUBIC)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', [noise, gradient, gradient.rotate(90 + seed % 180)])
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    # /image/<seed>.<ext>?w=&h=&fmt=&latency=&status= serves a synthetic image.
+    # /dropbox.com/s/<seed>/<name>.<ext> behaves like a Dropbox share link: the
+    # ?dl=0 preview URL returns an HTML page and ?raw=1 returns the image.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        time.sleep(float(params.get('latency', 0)))
+
+        if 'status' in params:
+            return self.send_body(int(params['status']), 'text/plain', b'error')
+        if parsed.path.startswith('/dropbox.com/') and params.get('dl') == '0':
+            return self.send_body(200, 'text/html', b'<html><body>Dropbox preview</body></html>')
+
+        seed = int(parsed.path.strip('/').split('/')[-1].split('.')[0].split('_')[0])
+        image_format = params.get('fmt', 'JPEG')
+        body = render_image(seed % IMAGE_VARIANTS, int(params.get('w', 800)), int(params.get('h', 600)), image_format)
+        self.send_body(200, IMAGE_CONTENT_TYPES[image_format], body)
+
+
+def start_image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def image_urls(args, base_url, dropbox):
+    rng = random.Random(args.seed)
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+    formats = args.formats.split(',')
+    for row in range(args.rows):
+        width, height = rng.choice(sizes)
+        latency = rng.expovariate(1000 / args.latency_ms) if args.latency_ms else 0
+        query = f"w={width}&h={height}&fmt={rng.choice(formats)}&latency={latency:.4f}"
+        if rng.random() < args.error_rate:
+            query += f"&status={rng.choice([404, 500, 503])}"
+        if dropbox:
+            yield f"{base_url}/dropbox.com/s/{row}/{row}.jpg?dl=0&{query}"
+        else:
+            yield f"{base_url}/image/{row}.jpg?{query}"
+
+
+def prerender_images(args):
+    for size in args.sizes.split(','):
+        width, height = (int(value) for value in size.split('x'))
+        for image_format in args.formats.split(','):
+            for seed in range(IMAGE_VARIANTS):
+                render_image(seed, width, height, image_format)
+
+
+def write_image_csv(path, urls):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Image link', 'Image Name'])
+        for row, url in enumerate(urls):
+            writer.writerow([url, f"image_{row}"])
+
+
+def write_msn_csv(path, args):
+    rng = random.Random(args.seed)
+    descriptions = [f"Product {value} {rng.choice(['Drill', 'Hammer', 'Spanner'])}" for value in range(args.unique_rows // 3)]
+    with open(path, 'w', newline='', encoding='ISO-8859-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(['MSN', 'uom', 'MSN_Description', 'Price'])
+        for row in range(args.unique_rows):
+            writer.writerow([f"MSN{row}", rng.choice(['PCS', 'SET', 'BOX']), rng.choice(descriptions), rng.randint(1, 999)])
+
+
+# Blank and numeric uom values whose inferred type differs between chunks of
+# three rows: a chunk that is blank throughout, int in one chunk and text in the
+# next, and ints that a blank elsewhere turns into floats.
+DEDUP_CHECK_CSVS = [
+    'MSN,uom,MSN_Description\n1,PCS,x\n2,PCS,y\n3,,x\n4,,x\n5,,y\n6,,x\n',
+    'MSN,uom,MSN_Description\n1,1,x\n2,2,y\n3,1,z\n4,1,x\n5,EA,y\n6,1,x\n',
+    'MSN,uom,MSN_Description\n1,1,a\n2,2,b\n3,3,c\n4,,d\n5,1,a\n6,,d\n',
+    'MSN,uom,MSN_Description\n1,1,a\n2,,a\n3,,a\n4,1.0,a\n',
+]
+
+
+def original_dedup(input_path, output_path):
+    # The /uploadunique loop before it was vectorized.
+    import pandas as pd
+    df = pd.read_csv(input_path, encoding='ISO-8859-1')
+    df['Unique_Or_Duplicate'] = 'Unique'
+    df['Duplicate_Of'] = None
+    duplicate_tracker = {}
+    for index, row in df.iterrows():
+        identifier = (row['uom'], row['MSN_Description'])
+        if identifier in duplicate_tracker:
+            df.at[index, 'Unique_Or_Duplicate'] = 'Duplicate'
+            df.at[index, 'Duplicate_Of'] = duplicate_tracker[identifier]
+        else:
+            duplicate_tracker[identifier] = row['MSN']
+    df.to_csv(output_path, index=False)
+
+
+def check_dedup(image_app, input_path, work_dir):
+    paths = [input_path]
+    for index, text in enumerate(DEDUP_CHECK_CSVS):
+        paths.append(os.path.join(work_dir, f'dedup_check_{index}.csv'))
+        with open(paths[-1], 'w') as f:
+            f.write(text)
+    config = image_app.app.config
+    defaults = config['DEDUP_CHUNK_THRESHOLD'], config['DEDUP_CHUNK_ROWS']
+    for path in paths:
+        expected_path, output_path = path + '.expected', path + '.out'
+        original_dedup(path, expected_path)
+        with open(expected_path, 'rb') as f:
+            expected = f.read()
+        with open(path) as f:
+            rows = sum(1 for _ in f) - 1
+        for threshold, chunk_rows in [defaults, (0, max(3, rows // 4))]:
+            config.update(DEDUP_CHUNK_THRESHOLD=threshold, DEDUP_CHUNK_ROWS=chunk_rows)
+            image_app.dedup_csv(path, output_path, ['uom', 'MSN_Description'])
+            with open(output_path, 'rb') as f:
+                if f.read() != expected:
+                    raise SystemExit(f"/uploadunique output differs from the original loop for {path} "
+                                     f"with DEDUP_CHUNK_THRESHOLD={threshold}, DEDUP_CHUNK_ROWS={chunk_rows}")
+    config.update(DEDUP_CHUNK_THRESHOLD=defaults[0], DEDUP_CHUNK_ROWS=defaults[1])
+    return len(paths)
+
+
+def write_pdf(path, args):
+    import fitz
+    document = fitz.open()
+    logo = render_image(0, 120, 60, 'PNG')
+    for page_num in range(args.pages):
+        page = document.new_page()
+        page.insert_image(fitz.Rect(20, 20, 140, 80), stream=logo)
+        page.insert_image(fitz.Rect(50, 120, 550, 495), stream=render_image(page_num + 1, 800, 600, 'JPEG'))
+    document.save(path)
+
+
+def render_subject_image(seed, width, height):
+    # A flat-coloured ellipse in front of the noise background, so the models
+    # have a foreground to segment.
+    image = Image.open(io.BytesIO(render_image(seed, width, height, 'JPEG'))).convert('RGB')
+    ImageDraw.Draw(image).ellipse((width // 4, height // 6, width * 3 // 4, height * 5 // 6),
+                                  fill=(200, 40 + seed * 40 % 200, 40))
+    return image
+
+
+def run_mask_scenario(image_app, args, timings):
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+    quality = args.bg_quality if args.bg_quality != 'full' else 'fast'
+    mask_size = image_app.app.config['REMBG_QUALITIES'][quality]
+    full_seconds, fast_seconds, differences = 0, 0, []
+    for index in range(args.mask_images):
+        image = render_subject_image(index % IMAGE_VARIANTS, *sizes[index % len(sizes)])
+        started = time.perf_counter()
+        image_app.remove_background(image, args.model)
+        full_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        image_app.remove_background_fast(image, args.model, mask_size)
+        fast_seconds += time.perf_counter() - started
+
+        full_mask = image_app.background_mask(image, args.model)
+        fast_mask = image_app.background_mask(image, args.model, mask_size)
+        differences.append(ImageStat.Stat(ImageChops.difference(full_mask, fast_mask)).mean[0] / 255)
+
+    return {
+        'rows': args.mask_images,
+        'seconds': fast_seconds,
+        'rows_per_sec': args.mask_images / fast_seconds if fast_seconds else 0,
+        'output_bytes': 0,
+        'mask': {
+            'quality': quality,
+            'full_seconds': full_seconds,
+            'speedup': full_seconds / fast_seconds if fast_seconds else 0,
+            'mean_difference': sum(differences) / len(differences),
+            'max_difference': max(differences),
+        },
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def instrument(module, timings):
+    for attribute, stage in STAGE_FUNCTIONS:
+        function = getattr(module, attribute, None)
+        if function is None:
+            continue
+
+        def timed(*args, _function=function, _stage=stage, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                timings.setdefault(_stage, []).append(time.perf_counter() - started)
+
+        setattr(module, attribute, timed)
+
+
+def post_and_collect(client, route, data, stream):
+    response = client.post(route, data=data, content_type='multipart/form-data')
+    if stream:
+        return sum(len(chunk) for chunk in response.response), None
+    if response.status_code == 202:
+        status = client.get(response.json['status_url']).json
+        return len(client.get(status['download_url']).data), status
+    location = response.headers.get('Location')
+    if location is None:
+        return len(response.data), None
+    job_id = location.rstrip('/').split('/')[-2]
+    status = client.get(f"/jobs/{job_id}").json
+    return len(client.get(location).data), status
+
+
+def run_scenario(name, args):
+    work_dir = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+
+    started = time.perf_counter()
+    import app as image_app
+    import_seconds = time.perf_counter() - started
+    if name == 'startup':
+        return {
+            'scenario': name,
+            'rows': 1,
+            'seconds': import_seconds,
+            'rows_per_sec': 1 / import_seconds,
+            'output_bytes': 0,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_child_rss_mb': 0,
+            'stages': {},
+        }
+
+    image_app.app.config.update(
+        UPLOAD_FOLDER=os.path.join(work_dir, 'uploads'),
+        JOBS_FOLDER=os.path.join(work_dir, 'jobs'),
+        HTTP_CACHE_FOLDER=os.path.join(work_dir, 'http_cache'),
+        OUTPUT_CACHE_FOLDER=os.path.join(work_dir, 'output_cache'),
+        CATALOG_INDEX_PATH=os.path.join(work_dir, 'catalog_index.sqlite3'),
+        REMBG_MODEL=args.model,
+    )
+    os.makedirs(image_app.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    timings = {}
+    instrument(image_app, timings)
+    client = image_app.app.test_client()
+    base_url = args.server_url
+    delivery = {'stream': '1'} if args.stream else {}
+    encoding = {'output_format': args.output_format, 'bg_quality': args.bg_quality,
+                **({'max_kb': str(args.max_kb)} if args.max_kb else {})}
+
+    if name == 'upload':
+        input_path = os.path.join(work_dir, 'images.csv')
+        write_image_csv(input_path, image_urls(args, base_url, dropbox=False))
+        rows = args.rows
+        data = {'option': args.option, 'width': str(args.width), 'height': str(args.height), 'model': args.model, **encoding, **delivery}
+        route, field = '/upload', 'file'
+    elif name == 'dropbox':
+        input_path = os.path.join(work_dir, 'dropbox.csv')
+        write_image_csv(input_path, image_urls(args, base_url, dropbox=True))
+        rows = args.rows
+        data = {'action': args.action, 'width': str(args.width), 'height': str(args.height), 'model': args.model, **encoding, **delivery}
+        route, field = '/dropbox', 'csv_file'
+    elif name == 'bgmask':
+        input_path = None
+    elif name == 'uploadunique':
+        input_path = os.path.join(work_dir, 'msn.csv')
+        write_msn_csv(input_path, args)
+        rows = args.unique_rows
+        data = {}
+        if args.catalog:
+            # Seed the index with the same rows, so every key is found in it.
+            data['catalog'] = '1'
+            with open(input_path, 'rb') as f:
+                post_and_collect(client, '/uploadunique', {**data, 'file': (io.BytesIO(f.read()), 'seed.csv')}, False)
+            timings.clear()
+        route, field = '/uploadunique', 'file'
+    else:
+        input_path = os.path.join(work_dir, 'catalog.pdf')
+        write_pdf(input_path, args)
+        rows = args.pages
+        data = dict(delivery)
+        if args.pdf_mode == 'pages':
+            data.update(mode='pages', dpi=str(args.dpi), page_format=args.page_format)
+        route, field = '/pdfimage', 'file'
+
+    if name == 'bgmask':
+        result = run_mask_scenario(image_app, args, timings)
+    else:
+        with open(input_path, 'rb') as f:
+            data[field] = (io.BytesIO(f.read()), os.path.basename(input_path))
+
+        started = time.perf_counter()
+        output_bytes, status = post_and_collect(client, route, data, args.stream and name != 'uploadunique')
+        seconds = time.perf_counter() - started
+        result = {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds else 0,
+            'output_bytes': output_bytes,
+            'job': (status or {}).get('stats', {}),
+            'job_stages': (status or {}).get('stages', {}),
+        }
+        if name == 'uploadunique' and args.check_dedup:
+            measured = {stage: list(values) for stage, values in timings.items()}
+            result['dedup_files_checked'] = check_dedup(image_app, input_path, work_dir)
+            timings.clear()
+            timings.update(measured)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        'scenario': name,
+        **result,
+        'peak_rss_mb': usage / 1024,
+        'peak_child_rss_mb': children / 1024,
+        'stages': {
+            stage: {
+                'count': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+            for stage, values in timings.items() if values
+        },
+    }
+
+
+def run_in_subprocess(name, argv, server_url):
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        result_path = f.name
+    command = [sys.executable, os.path.abspath(__file__), *argv,
+               '--server-url', server_url, '--run-scenario', name, '--result-file', result_path]
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL if not os.environ.get('BENCHMARK_VERBOSE') else None)
+    if completed.returncode != 0:
+        raise SystemExit(f"Scenario {name} failed with exit code {completed.returncode}")
+    with open(result_path) as f:
+        result = json.load(f)
+    os.remove(result_path)
+    return result
+
+
+def print_report(results, baseline=None):
+    baseline = {result['scenario']: result for result in (baseline or [])}
+    print(f"{'scenario':<14}{'rows':>8}{'seconds':>10}{'rows/s':>10}{'out MB':>10}{'peak MB':>10}{'child MB':>10}  vs baseline")
+    for result in results:
+        before = baseline.get(result['scenario'])
+        change = ''
+        if before and before['rows_per_sec']:
+            change = f"{(result['rows_per_sec'] / before['rows_per_sec'] - 1) * 100:+.1f}% rows/s, " \
+                     f"{result['peak_rss_mb'] - before['peak_rss_mb']:+.1f} MB"
+        print(f"{result['scenario']:<14}{result['rows']:>8}{result['seconds']:>10.2f}{result['rows_per_sec']:>10.1f}"
+              f"{result['output_bytes'] / 1024 / 1024:>10.2f}{result['peak_rss_mb']:>10.1f}{result['peak_child_rss_mb']:>10.1f}  {change}")
+        if 'mask' in result:
+            mask = result['mask']
+            print(f"    {mask['quality']} mask vs full size: {mask['speedup']:.1f}x faster "
+                  f"({mask['full_seconds']:.2f}s -> {result['seconds']:.2f}s), mask difference "
+                  f"mean {mask['mean_difference'] * 100:.2f}% max {mask['max_difference'] * 100:.2f}%")
+        for stage, timing in sorted(result['stages'].items()):
+            print(f"    {stage:<24}n={timing['count']:<7}p50={timing['p50_ms']:.1f}ms "
+                  f"p95={timing['p95_ms']:.1f}ms p99={timing['p99_ms']:.1f}ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS), help='comma separated subset of ' + ','.join(SCENARIOS))
+    parser.add_argument('--rows', type=int, default=200, help='image rows for /upload and /dropbox')
+    parser.add_argument('--unique-rows', type=int, default=200000, help='rows in the /uploadunique CSV')
+    parser.add_argument('--catalog', action='store_true', help='check /uploadunique against a seeded catalog index')
+    parser.add_argument('--check-dedup', action='store_true', help='compare /uploadunique output with the original loop, '
+                        'whole and chunked')
+    parser.add_argument('--pages', type=int, default=50, help='pages in the /pdfimage PDF')
+    parser.add_argument('--pdf-mode', default='images', help='/pdfimage mode: images or pages')
+    parser.add_argument('--dpi', type=int, default=150, help='page render DPI with --pdf-mode pages')
+    parser.add_argument('--page-format', default='png', help='page render format with --pdf-mode pages')
+    parser.add_argument('--sizes', default='400x300,1200x900,3000x2400', help='source image sizes to mix')
+    parser.add_argument('--formats', default='JPEG,PNG', help='source image formats to mix')
+    parser.add_argument('--latency-ms', type=float, default=50, help='mean simulated server latency')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='fraction of URLs that return an HTTP error')
+    parser.add_argument('--option', default='resize', help='/upload option')
+    parser.add_argument('--action', default='resize', help='/dropbox action')
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=400)
+    parser.add_argument('--model', default='u2net', help='background removal model')
+    parser.add_argument('--bg-quality', default='full', help='background removal quality for /upload and /dropbox, '
+                        'and the quality compared against full size by bgmask')
+    parser.add_argument('--mask-images', type=int, default=12, help='images compared by the bgmask scenario')
+    parser.add_argument('--output-format', default='jpeg', help='output encoding for /upload and /dropbox')
+    parser.add_argument('--max-kb', type=int, help='per-image byte budget for /upload and /dropbox')
+    parser.add_argument('--stream', action='store_true', help='use the streaming ZIP response')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='PATH', help='write results to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='compare against results saved with --save-baseline')
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.run_scenario:
+        result = run_scenario(args.run_scenario, args)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    passthrough = list(sys.argv[1:])
+    for flag in ('--save-baseline', '--compare'):
+        if flag in passthrough:
+            index = passthrough.index(flag)
+            del passthrough[index:index + 2]
+
+    # The image server runs here so its memory and CPU stay out of the scenario measurements.
+    prerender_images(args)
+    server = start_image_server()
+    server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    results = [run_in_subprocess(name, passthrough, server_url) for name in args.scenarios.split(',')]
+    server.shutdown()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+import os
+
+# gunicorn reads this file when started from the project folder (gunicorn app:app).
+#
+# PRELOAD_REMBG_MODELS=u2net,u2netp imports the app and loads those background
+# removal models in the master before workers are forked. Workers then share
+# the model memory copy-on-write and run background removal in-process instead
+# of each starting its own pool of model processes.
+preload_models = [name for name in os.environ.get('PRELOAD_REMBG_MODELS', '').split(',') if name]
+preload_app = bool(preload_models)
+
+
+def when_ready(server):
+    if preload_models:
+        import app
+        app.preload_rembg_models(preload_models)